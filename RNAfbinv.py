@@ -14,7 +14,7 @@ import logging
 import time
 import os
 
-from rnafbinv import shapiro_generator, sfb_designer, RNAfbinvCL, vienna, IUPAC
+from rnafbinv import shapiro_generator, sfb_designer, RNAfbinvCL, vienna, IUPAC, parallel
 import varna_generator
 
 
@@ -607,30 +607,29 @@ class RNAfbinvGUI(tk.Frame):
             self.create_query_widgets()
 
     def run_all(self, arguments, progression_list):
-        rna_folder = vienna.LiveRNAfold(logging)
-        rna_folder.start(False)
-        arguments['RNAfold'] = rna_folder
         arguments['logger'] = logging
+        self.arguments = arguments
         self.info_componenets['result_list'] = []
-        for item in progression_list:
+
+        def progress(design_index, iteration):
+            if self.keep_running:
+                progression_list[design_index].update(iteration)
+
+        # independent designs run concurrently, results arrive in completion order
+        logging.debug("Starting designs\nArguments: {}".format(arguments))
+        for design_index, seed, result_object in parallel.design_many(arguments, len(progression_list),
+                                                                      progress=progress):
             if not self.keep_running:
                 break
-            # run simulated annealing
-            arguments['updater'] = item
-            self.arguments = arguments
-            logging.debug("Starting simulated_annealing\nArguments: {}".format(arguments))
-            designed_sequence = sfb_designer.simulated_annealing(arguments)
-            logging.debug("Finished simulated_annealing\nSequence: {}".format(designed_sequence))
-            if self.keep_running:
-                if designed_sequence is not None:
-                    logging.info("Finished simulated annealing, resulting sequence: {}".format(designed_sequence))
-                    result_object = sfb_designer.generate_res_object(designed_sequence, arguments)
-                    item.update_res(result_object)
-                    self.info_componenets['result_list'].append(result_object)
-                else:
-                    item.update_fail()
+            item = progression_list[design_index]
+            if result_object is not None:
+                logging.info("Finished design {} (seed {}), resulting sequence: {}".format(design_index + 1, seed,
+                                                                                          result_object.sequence))
+                item.update_res(result_object)
+                self.info_componenets['result_list'].append(result_object)
+            else:
+                item.update_fail()
         self.info_componenets['export_button']['state'] = tk.NORMAL
-        rna_folder.close()
 
     def export_results(self):
         files = [('All Files', '*.*'),
@@ -24,6 +24,7 @@ def read_config():
         varna_generator.set_varna_path(varna)
 
 
-read_config()
-result = RNAfbinvCL.main(' '.join(sys.argv[1:]))
+if __name__ == '__main__':
+    read_config()
+    result = RNAfbinvCL.main(' '.join(sys.argv[1:]))
 
@@ -1,6 +1,10 @@
 import time
+import random
+import collections
 from typing import List
 
+import numpy as np
+
 IUPAC_DNA_A = "A"
 IUPAC_DNA_C = "C"
 IUPAC_DNA_G = "G"
@@ -31,6 +35,15 @@ IUPAC_XNA_MAP = {'A': IUPAC_DNA_A, 'C': IUPAC_DNA_C, 'G': IUPAC_DNA_G, 'T': IUPA
                  'B': IUPAC_DNA_B,
                  'D': IUPAC_DNA_D, 'H': IUPAC_DNA_H, 'V': IUPAC_DNA_V, 'N': IUPAC_DNA_N, '.': IUPAC_DNA_DOT}
 
+# Bit mask for each IUPAC code (A=1, C=2, G=4, T/U=8, '.'=16), two codes agree when their masks intersect
+IUPAC_BIT_MAP = {'A': 1, 'C': 2, 'G': 4, 'T': 8, 'U': 8, '.': 16}
+IUPAC_MASK_MAP = {code: sum(set(IUPAC_BIT_MAP[c] for c in bases)) for code, bases in IUPAC_XNA_MAP.items()}
+# ascii code to bit mask lookup (upper and lower case), 0 marks an unknown code
+IUPAC_MASK_TABLE = np.zeros(256, dtype=np.uint8)
+for _code, _mask in IUPAC_MASK_MAP.items():
+    IUPAC_MASK_TABLE[ord(_code)] = _mask
+    IUPAC_MASK_TABLE[ord(_code.lower())] = _mask
+
 
 # Algorithm definitions
 # match - match from sequence one and sequence two
@@ -75,9 +88,114 @@ class SequenceAlignmentScore:
         self.insert_func = insert_func
 
 
-def align_iupac_dna_sequence(seq_one, seq_two, sequence_alignment_score=SequenceAlignmentScore()):
-    score_matrix = [([0] * (len(seq_two) + 1)) for i in range(0, len(seq_one) + 1)]
+# Alignment score with a fixed scheme that can be aligned without per cell callbacks:
+# match is decided by agree(match_score_N, match_score, mismatch_penalty) and the delete / insert functions may only
+# depend on sequence two and it's index (sequence one and it's index are passed as 0).
+# minmax_func must be min or max.
+class VectorizedAlignmentScore(SequenceAlignmentScore):
+    def __init__(self, minmax_func=max, match_score_N=1, match_score=1, mismatch_penalty=-1,
+                 delete_func=lambda s1, i1, s2, i2: 0, insert_func=lambda s1, i1, s2, i2: 0):
+        super().__init__(minmax_func=minmax_func, match_func=self.agree_match, delete_func=delete_func,
+                         insert_func=insert_func)
+        self.match_score_N = match_score_N
+        self.match_score = match_score
+        self.mismatch_penalty = mismatch_penalty
+
+    def agree_match(self, s1, i1, s2, i2):
+        return agree(s1[i1], s2[i2], self.match_score_N, self.match_score, self.mismatch_penalty)
+
+    # Match cost matrix (len(seq_one) x len(seq_two))
+    def match_costs(self, seq_one, seq_two):
+        common = (encode_masks(seq_one)[:, None] & encode_masks(seq_two)[None, :]) != 0
+        is_n = np.array([c in 'Nn' for c in seq_two], dtype=bool)
+        return np.where(common, np.where(is_n, self.match_score_N, self.match_score)[None, :], self.mismatch_penalty)
+
+    # Insert and delete cost per score matrix column (index 0 of delete is unused).
+    # Returns None if one of the functions does not return a score (legacy path handles it)
+    def gap_costs(self, seq_one, seq_two):
+        insert_costs = [self.insert_func(seq_one, 0, seq_two, max(two_index - 1, 0))
+                        for two_index in range(0, len(seq_two) + 1)]
+        delete_costs = [0] + [self.delete_func(seq_one, 0, seq_two, two_index) for two_index in range(0, len(seq_two))]
+        if None in insert_costs or None in delete_costs:
+            return None
+        return insert_costs, delete_costs
+
+
+# Turns a sequence into an array of IUPAC bit masks
+def encode_masks(sequence: str) -> np.ndarray:
+    masks = IUPAC_MASK_TABLE[np.frombuffer(sequence.encode('ascii', errors='replace'), dtype=np.uint8)]
+    if not masks.all():
+        raise ValueError("{} is not a know IUPAC DNA code".format(sequence[int(np.argmin(masks))]))
+    return masks
+
+
+# Below this many cells the numpy call overhead is higher than filling the matrix in python
+VECTOR_MIN_CELLS = 64
+
+
+# Small score matrix rows from the pre computed gap costs without calling the alignment functions per cell
+def _iter_small_rows(seq_one, seq_two, sequence_alignment_score: VectorizedAlignmentScore, gap_costs):
+    choose = sequence_alignment_score.minmax_func
+    insert_costs, delete_costs = gap_costs
+    masks_two = [IUPAC_MASK_MAP.get(c.upper()) for c in seq_two]
+    match_two = [sequence_alignment_score.match_score_N if c in 'Nn' else sequence_alignment_score.match_score
+                 for c in seq_two]
+    row = [0]
+    for two_index in range(1, len(seq_two) + 1):
+        row.append(row[two_index - 1] + delete_costs[two_index])
+    yield row
+    for one_index in range(1, len(seq_one) + 1):
+        mask_one = IUPAC_MASK_MAP.get(seq_one[one_index - 1].upper())
+        if seq_two and (mask_one is None or None in masks_two):
+            # raise the same error as agree
+            common_dna_code(seq_one[one_index - 1], seq_two[masks_two.index(None) if None in masks_two else 0])
+        last_row = row
+        row = [last_row[0] + insert_costs[0]]
+        for two_index in range(1, len(seq_two) + 1):
+            change = match_two[two_index - 1] if mask_one & masks_two[two_index - 1] else \
+                sequence_alignment_score.mismatch_penalty
+            row.append(choose(last_row[two_index - 1] + change, last_row[two_index] + insert_costs[two_index],
+                              row[two_index - 1] + delete_costs[two_index]))
+        yield row
+
+
+# Score matrix rows with numpy row sweeps. Within a row the delete transitions form a prefix scan:
+# row[j] = min_k<=j(candidate[k] + del[k+1..j]) which is solved with a cumulative sum and an accumulated min / max
+def _iter_numpy_rows(seq_one, seq_two, sequence_alignment_score: VectorizedAlignmentScore, gap_costs, choose):
+    insert_costs = np.array(gap_costs[0])
+    delete_cumsum = np.cumsum(gap_costs[1])
+    match_costs = sequence_alignment_score.match_costs(seq_one, seq_two) if seq_one and seq_two else None
+    row = delete_cumsum
+    yield row
+    for one_index in range(1, len(seq_one) + 1):
+        candidates = row + insert_costs
+        if match_costs is not None:
+            choose(candidates[1:], row[:-1] + match_costs[one_index - 1], out=candidates[1:])
+        row = choose.accumulate(candidates - delete_cumsum) + delete_cumsum
+        yield row
+
+
+# Returns an iterator over the score matrix rows of a vectorized alignment score, None if it can not be vectorized
+def _vectorized_rows(seq_one, seq_two, sequence_alignment_score: VectorizedAlignmentScore):
+    if sequence_alignment_score.minmax_func is min:
+        choose = np.minimum
+    elif sequence_alignment_score.minmax_func is max:
+        choose = np.maximum
+    else:
+        return None
+    gap_costs = sequence_alignment_score.gap_costs(seq_one, seq_two)
+    if gap_costs is None:
+        return None
+    if (len(seq_one) + 1) * (len(seq_two) + 1) < VECTOR_MIN_CELLS:
+        return _iter_small_rows(seq_one, seq_two, sequence_alignment_score, gap_costs)
+    return _iter_numpy_rows(seq_one, seq_two, sequence_alignment_score, gap_costs, choose)
+
+
+# Score matrix rows using the alignment score functions for each cell
+def _iter_rows(seq_one, seq_two, sequence_alignment_score: SequenceAlignmentScore):
+    last_row = None
     for one_index in range(0, len(seq_one) + 1):
+        row = [0] * (len(seq_two) + 1)
         for two_index in range(0, len(seq_two) + 1):
             if one_index == 0 and two_index == 0:
                 continue
@@ -85,20 +203,44 @@ def align_iupac_dna_sequence(seq_one, seq_two, sequence_alignment_score=Sequence
             # Match or mismatch (score decided by agree)
             if one_index > 0 and two_index > 0:
                 score = sequence_alignment_score.match_func(seq_one, one_index - 1, seq_two, two_index - 1)
-                choose_list.append(score_matrix[one_index - 1][two_index - 1] + score)
+                choose_list.append(last_row[two_index - 1] + score)
             # insert from seq 1
             if one_index > 0:
                 insert_penalty = sequence_alignment_score.insert_func(seq_one, one_index - 1, seq_two,
                                                                       max(two_index - 1, 0))
-                choose_list.append(score_matrix[one_index - 1][two_index] + insert_penalty)
+                choose_list.append(last_row[two_index] + insert_penalty)
             # "delete" from seq 2
             if two_index > 0:
                 # N is wildcard, deletion of it should be different
                 delete_penalty = sequence_alignment_score.delete_func(seq_one, max(one_index - 1, 0), seq_two,
                                                                       two_index - 1)
-                choose_list.append(score_matrix[one_index][two_index - 1] + delete_penalty)
-            score_matrix[one_index][two_index] = sequence_alignment_score.minmax_func(choose_list)
-    return score_matrix
+                choose_list.append(row[two_index - 1] + delete_penalty)
+            row[two_index] = sequence_alignment_score.minmax_func(choose_list)
+        yield row
+        last_row = row
+
+
+def iter_score_rows(seq_one, seq_two, sequence_alignment_score=SequenceAlignmentScore()):
+    rows = None
+    if isinstance(sequence_alignment_score, VectorizedAlignmentScore):
+        rows = _vectorized_rows(seq_one, seq_two, sequence_alignment_score)
+    if rows is None:
+        rows = _iter_rows(seq_one, seq_two, sequence_alignment_score)
+    return rows
+
+
+def align_iupac_dna_sequence(seq_one, seq_two, sequence_alignment_score=SequenceAlignmentScore()):
+    return [row if isinstance(row, list) else row.tolist()
+            for row in iter_score_rows(seq_one, seq_two, sequence_alignment_score)]
+
+
+# Optimal alignment score only, keeps a single score matrix row at a time (no traceback)
+def get_alignment_score(seq_one, seq_two, sequence_alignment_score=SequenceAlignmentScore()):
+    row = None
+    for row in iter_score_rows(seq_one, seq_two, sequence_alignment_score):
+        pass
+    score = row[-1]
+    return score if isinstance(row, list) else score.item()
 
 
 def get_best_score(score_matrix):
@@ -113,64 +255,243 @@ class IUPACAlignmentError(Exception):
 # returns all optimal alignments
 def generate_optimal_alignments(seq_one, seq_two, score_matrix=None, sequence_alignment_score=SequenceAlignmentScore(),
                                 return_single=False):
+    return list(iter_optimal_alignments(seq_one, seq_two, score_matrix=score_matrix,
+                                        sequence_alignment_score=sequence_alignment_score,
+                                        limit=1 if return_single else None))
+
+
+# Yields optimal alignments one by one (depth first, match then insert then delete), stops after limit alignments.
+# Pending branches share their alignment suffix as back pointer nodes (char one, char two, next node), strings are
+# only built for yielded alignments.
+def iter_optimal_alignments(seq_one, seq_two, score_matrix=None, sequence_alignment_score=SequenceAlignmentScore(),
+                            limit=None):
     if score_matrix is None:
         score_matrix = align_iupac_dna_sequence(seq_one, seq_two, sequence_alignment_score)
-    results = []
-    alignment_stack = [("", "", (len(seq_one), len(seq_two)))]
-    while len(alignment_stack) > 0:
-        align_one, align_two, matrix_index = alignment_stack.pop()
-        # print("Running from stack: {}\n{}\n{}".format(matrix_index, align_one, align_two))
-        while matrix_index[0] > 0 or matrix_index[1] > 0:
-            # print("start round: {}\n{}\n{}".format(matrix_index, align_one, align_two))
-            matched_this_round = False
-            round_align_one = None
-            round_align_two = None
-            round_matrix_index = None
-            curr_score = score_matrix[matrix_index[0]][matrix_index[1]]
-            # mismatch / match
-            if matrix_index[0] > 0 and matrix_index[1] > 0:
-                change = sequence_alignment_score.match_func(seq_one, matrix_index[0] - 1, seq_two, matrix_index[1] - 1)
-                if curr_score == score_matrix[matrix_index[0] - 1][matrix_index[1] - 1] + change:
-                    round_align_one = seq_one[matrix_index[0] - 1] + align_one
-                    round_align_two = seq_two[matrix_index[1] - 1] + align_two
-                    matched_this_round = True
-                    round_matrix_index = (matrix_index[0] - 1, matrix_index[1] - 1)
-            # insert
-            if matrix_index[0] > 0:
-                change = sequence_alignment_score.insert_func(seq_one, matrix_index[0] - 1, seq_two,
-                                                              max(matrix_index[1] - 1, 0))
-                if curr_score == score_matrix[matrix_index[0] - 1][matrix_index[1]] + change:
-                    if matched_this_round and not return_single:
-                        alignment_stack.insert(0, (seq_one[matrix_index[0] - 1] + align_one, '-' + align_two,
-                                                   (matrix_index[0] - 1, matrix_index[1])))
-                    elif not matched_this_round:
-                        round_align_one = seq_one[matrix_index[0] - 1] + align_one
-                        round_align_two = '-' + align_two
-                        round_matrix_index = (matrix_index[0] - 1, matrix_index[1])
-                        matched_this_round = True
-            # delete
-            if matrix_index[1] > 0:
-                change = sequence_alignment_score.delete_func(seq_one, max(matrix_index[0] - 1, 0), seq_two,
-                                                               matrix_index[1] - 1)
-                if curr_score == score_matrix[matrix_index[0]][matrix_index[1] - 1] + change:
-                    if matched_this_round and not return_single:
-                        alignment_stack.insert(0, ('-' + align_one, seq_two[matrix_index[1] - 1] + align_two,
-                                                   (matrix_index[0], matrix_index[1] - 1)))
-                    elif not matched_this_round:
-                        round_align_one = '-' + align_one
-                        round_align_two = seq_two[matrix_index[1] - 1] + align_two
-                        round_matrix_index = (matrix_index[0], matrix_index[1] - 1)
-                        matched_this_round = True
-            if not matched_this_round:
-                # Should NEVER arrive here, to check that we selected one of the options
-                raise IUPACAlignmentError("Score matrix, no match! {}\n{}".format((matrix_index[0], matrix_index[1])
-                                                                                  , score_matrix))
-            align_one = round_align_one
-            align_two = round_align_two
-            matrix_index = round_matrix_index
-        # print("End stack:\n{}\n{}".format(align_one, align_two))
-        results.append((align_one, align_two))
-    return results
+    found = 0
+    alignment_stack = collections.deque([((len(seq_one), len(seq_two)), None)])
+    while alignment_stack and (limit is None or found < limit):
+        matrix_index, path = alignment_stack.pop()
+        one_index, two_index = matrix_index
+        if one_index == 0 and two_index == 0:
+            align_one = []
+            align_two = []
+            while path is not None:
+                align_one.append(path[0])
+                align_two.append(path[1])
+                path = path[2]
+            found += 1
+            yield "".join(align_one), "".join(align_two)
+            continue
+        curr_score = score_matrix[one_index][two_index]
+        options = []
+        # mismatch / match
+        if one_index > 0 and two_index > 0:
+            change = sequence_alignment_score.match_func(seq_one, one_index - 1, seq_two, two_index - 1)
+            if curr_score == score_matrix[one_index - 1][two_index - 1] + change:
+                options.append(((one_index - 1, two_index - 1),
+                                (seq_one[one_index - 1], seq_two[two_index - 1], path)))
+        # insert
+        if one_index > 0:
+            change = sequence_alignment_score.insert_func(seq_one, one_index - 1, seq_two, max(two_index - 1, 0))
+            if curr_score == score_matrix[one_index - 1][two_index] + change:
+                options.append(((one_index - 1, two_index), (seq_one[one_index - 1], '-', path)))
+        # delete
+        if two_index > 0:
+            change = sequence_alignment_score.delete_func(seq_one, max(one_index - 1, 0), seq_two, two_index - 1)
+            if curr_score == score_matrix[one_index][two_index - 1] + change:
+                options.append(((one_index, two_index - 1), ('-', seq_two[two_index - 1], path)))
+        if not options:
+            # Should NEVER arrive here, to check that we selected one of the options
+            raise IUPACAlignmentError("Score matrix, no match! {}\n{}".format(matrix_index, score_matrix))
+        # preferred option is explored first
+        alignment_stack.extend(options[::-1])
+
+
+# Above this length (of both sequences) single optimal alignments are generated in linear space
+LINEAR_SPACE_LENGTH = 500
+# Sub problems up to this many cells are aligned with a full score matrix
+LINEAR_SPACE_BLOCK = 4096
+
+
+# Transition costs into score matrix cells of a single row (absolute indexes, no full matrix)
+class _RowCosts:
+    def __init__(self, seq_one, seq_two, sequence_alignment_score: SequenceAlignmentScore):
+        self.seq_one = seq_one
+        self.seq_two = seq_two
+        self.sequence_alignment_score = sequence_alignment_score
+        self.gap_costs = None
+        if isinstance(sequence_alignment_score, VectorizedAlignmentScore):
+            self.gap_costs = sequence_alignment_score.gap_costs(seq_one, seq_two)
+        if self.gap_costs is not None:
+            self.insert_costs = np.array(self.gap_costs[0])
+            self.delete_costs = np.array(self.gap_costs[1])
+            if seq_one and seq_two:
+                self.masks_one = encode_masks(seq_one)
+                self.masks_two = encode_masks(seq_two)
+                self.match_two = np.where(np.array([c in 'Nn' for c in seq_two], dtype=bool),
+                                          sequence_alignment_score.match_score_N, sequence_alignment_score.match_score)
+
+    # match / mismatch into cells (one_index, two_start + 1 .. two_end)
+    def diagonal(self, one_index, two_start, two_end):
+        if two_end <= two_start:
+            return np.zeros(0, dtype=int)
+        if self.gap_costs is not None:
+            return np.where((self.masks_one[one_index - 1] & self.masks_two[two_start:two_end]) != 0,
+                            self.match_two[two_start:two_end], self.sequence_alignment_score.mismatch_penalty)
+        return np.array([self.sequence_alignment_score.match_func(self.seq_one, one_index - 1, self.seq_two, two_index)
+                         for two_index in range(two_start, two_end)])
+
+    # insert from sequence one into cells (one_index, two_start .. two_end)
+    def vertical(self, one_index, two_start, two_end):
+        if self.gap_costs is not None:
+            return self.insert_costs[two_start:two_end + 1]
+        return np.array([self.sequence_alignment_score.insert_func(self.seq_one, one_index - 1, self.seq_two,
+                                                                   max(two_index - 1, 0))
+                         for two_index in range(two_start, two_end + 1)])
+
+    # delete from sequence two into cells (one_index, two_start + 1 .. two_end)
+    def horizontal(self, one_index, two_start, two_end):
+        if self.gap_costs is not None:
+            return self.delete_costs[two_start + 1:two_end + 1]
+        return np.array([self.sequence_alignment_score.delete_func(self.seq_one, max(one_index - 1, 0), self.seq_two,
+                                                                   two_index)
+                         for two_index in range(two_start, two_end)])
+
+
+def _prefix_costs(costs):
+    return np.concatenate(([0], np.cumsum(costs))) if len(costs) else np.zeros(1, dtype=costs.dtype)
+
+
+# last row (one_end) of the score matrix for seq_one[one_start:one_end] x seq_two[two_start:two_end]
+def _forward_row(row_costs: _RowCosts, one_start, one_end, two_start, two_end, choose):
+    row = _prefix_costs(row_costs.horizontal(one_start, two_start, two_end))
+    for one_index in range(one_start + 1, one_end + 1):
+        candidates = row + row_costs.vertical(one_index, two_start, two_end)
+        if two_end > two_start:
+            choose(candidates[1:], row[:-1] + row_costs.diagonal(one_index, two_start, two_end), out=candidates[1:])
+        prefix = _prefix_costs(row_costs.horizontal(one_index, two_start, two_end))
+        row = choose.accumulate(candidates - prefix) + prefix
+    return row
+
+
+# first row (one_start) of the reverse score matrix: best score from each cell to (one_end, two_end)
+def _backward_row(row_costs: _RowCosts, one_start, one_end, two_start, two_end, choose):
+    prefix = _prefix_costs(row_costs.horizontal(one_end, two_start, two_end))
+    row = prefix[-1] - prefix
+    for one_index in range(one_end - 1, one_start - 1, -1):
+        candidates = row + row_costs.vertical(one_index + 1, two_start, two_end)
+        if two_end > two_start:
+            choose(candidates[:-1], row[1:] + row_costs.diagonal(one_index + 1, two_start, two_end),
+                   out=candidates[:-1])
+        prefix = _prefix_costs(row_costs.horizontal(one_index, two_start, two_end))
+        row = choose.accumulate((candidates + prefix)[::-1])[::-1] - prefix
+    return row
+
+
+# full score matrix of a small sub problem and a traceback (match, insert then delete as in generate_optimal_alignments)
+def _align_block(row_costs: _RowCosts, one_start, one_end, two_start, two_end, minmax_func):
+    score_matrix = []
+    for one_index in range(one_start, one_end + 1):
+        horizontal = row_costs.horizontal(one_index, two_start, two_end).tolist()
+        if one_index == one_start:
+            row = [0]
+            for cost in horizontal:
+                row.append(row[-1] + cost)
+        else:
+            last_row = score_matrix[-1]
+            vertical = row_costs.vertical(one_index, two_start, two_end).tolist()
+            diagonal = row_costs.diagonal(one_index, two_start, two_end).tolist()
+            row = [last_row[0] + vertical[0]]
+            for two_index in range(1, two_end - two_start + 1):
+                row.append(minmax_func(last_row[two_index - 1] + diagonal[two_index - 1],
+                                       last_row[two_index] + vertical[two_index],
+                                       row[two_index - 1] + horizontal[two_index - 1]))
+        score_matrix.append(row)
+    path = []
+    one_index = one_end - one_start
+    two_index = two_end - two_start
+    while one_index > 0 or two_index > 0:
+        curr_score = score_matrix[one_index][two_index]
+        if one_index > 0 and two_index > 0 and curr_score == score_matrix[one_index - 1][two_index - 1] + \
+                row_costs.diagonal(one_start + one_index, two_start + two_index - 1, two_start + two_index)[0]:
+            path.append((one_start + one_index - 1, two_start + two_index - 1))
+            one_index -= 1
+            two_index -= 1
+        elif one_index > 0 and curr_score == score_matrix[one_index - 1][two_index] + \
+                row_costs.vertical(one_start + one_index, two_start + two_index, two_start + two_index)[0]:
+            path.append((one_start + one_index - 1, None))
+            one_index -= 1
+        elif two_index > 0 and curr_score == score_matrix[one_index][two_index - 1] + \
+                row_costs.horizontal(one_start + one_index, two_start + two_index - 1, two_start + two_index)[0]:
+            path.append((None, two_start + two_index - 1))
+            two_index -= 1
+        else:
+            raise IUPACAlignmentError("Score matrix, no match! {}".format((one_start + one_index,
+                                                                           two_start + two_index)))
+    return path[::-1]
+
+
+# Hirschberg divide and conquer, the optimal path crosses the middle row at the column with the best forward +
+# backward score. Returns the path as (seq_one index or None, seq_two index or None) columns
+def _linear_space_path(row_costs: _RowCosts, one_start, one_end, two_start, two_end, minmax_func, choose):
+    if one_end - one_start <= 1 or (one_end - one_start + 1) * (two_end - two_start + 1) <= LINEAR_SPACE_BLOCK:
+        return _align_block(row_costs, one_start, one_end, two_start, two_end, minmax_func)
+    one_mid = (one_start + one_end) // 2
+    through_mid = _forward_row(row_costs, one_start, one_mid, two_start, two_end, choose) + \
+        _backward_row(row_costs, one_mid, one_end, two_start, two_end, choose)
+    two_mid = two_start + int(np.argmin(through_mid) if choose is np.minimum else np.argmax(through_mid))
+    return _linear_space_path(row_costs, one_start, one_mid, two_start, two_mid, minmax_func, choose) + \
+        _linear_space_path(row_costs, one_mid, one_end, two_mid, two_end, minmax_func, choose)
+
+
+# Optimal score and a single optimal alignment using O(len(seq_two)) memory (Hirschberg).
+# The alignment is optimal but may differ from the first one returned by generate_optimal_alignments.
+def align_linear_space(seq_one, seq_two, sequence_alignment_score=SequenceAlignmentScore()):
+    if sequence_alignment_score.minmax_func is min:
+        choose = np.minimum
+    elif sequence_alignment_score.minmax_func is max:
+        choose = np.maximum
+    else:
+        raise ValueError("Linear space alignment requires min or max as minmax_func")
+    row_costs = _RowCosts(seq_one, seq_two, sequence_alignment_score)
+    path = _linear_space_path(row_costs, 0, len(seq_one), 0, len(seq_two), sequence_alignment_score.minmax_func,
+                              choose)
+    align_one = ''.join('-' if one_index is None else seq_one[one_index] for one_index, _ in path)
+    align_two = ''.join('-' if two_index is None else seq_two[two_index] for _, two_index in path)
+    score = _forward_row(row_costs, 0, len(seq_one), 0, len(seq_two), choose)[-1]
+    return score.item(), (align_one, align_two)
+
+
+# Optimal score and a single optimal alignment, long sequences are aligned in linear space
+def get_optimal_alignment(seq_one, seq_two, sequence_alignment_score=SequenceAlignmentScore()):
+    if min(len(seq_one), len(seq_two)) >= LINEAR_SPACE_LENGTH and \
+            sequence_alignment_score.minmax_func in (min, max):
+        return align_linear_space(seq_one, seq_two, sequence_alignment_score)
+    score_matrix = align_iupac_dna_sequence(seq_one, seq_two, sequence_alignment_score)
+    return get_best_score(score_matrix), next(iter_optimal_alignments(seq_one, seq_two, score_matrix=score_matrix,
+                                                                      sequence_alignment_score=sequence_alignment_score,
+                                                                      limit=1))
+
+
+# Score of a given alignment (used to validate alignments)
+def score_alignment(align_one, align_two, sequence_alignment_score=SequenceAlignmentScore()):
+    seq_one = align_one.replace('-', '')
+    seq_two = align_two.replace('-', '')
+    one_index = 0
+    two_index = 0
+    score = 0
+    for char_one, char_two in zip(align_one, align_two):
+        if char_one != '-' and char_two != '-':
+            score += sequence_alignment_score.match_func(seq_one, one_index, seq_two, two_index)
+            one_index += 1
+            two_index += 1
+        elif char_one != '-':
+            score += sequence_alignment_score.insert_func(seq_one, one_index, seq_two, max(two_index - 1, 0))
+            one_index += 1
+        else:
+            score += sequence_alignment_score.delete_func(seq_one, max(one_index - 1, 0), seq_two, two_index)
+            two_index += 1
+    return score
 
 
 if __name__ == "__main__":
@@ -268,3 +589,41 @@ if __name__ == "__main__":
     seq_a = 'CAGUGU'
     seq_b = 'auunng'
     test(7, seq_a, seq_b, sequence_alignment_object)
+
+    # Test 8 - vectorized engine against the python engine on a random corpus
+    vectorized_alignment_object = VectorizedAlignmentScore(
+        delete_func=del_lower,
+        insert_func=sequence_alignment_object.insert_func,
+        match_score_N=0, match_score=0, mismatch_penalty=1000,
+        minmax_func=min)
+    random.seed(1)
+    mismatch_count = 0
+    for i in range(0, 500):
+        seq_a = ''.join(random.choice(IUPAC_RNA_BASE) for j in range(0, random.randint(0, 40)))
+        seq_b = ''.join(random.choice('NNNNNNACGURYK') for j in range(0, random.randint(0, 40)))
+        if seq_b:
+            motif_start = random.randint(0, len(seq_b) - 1)
+            motif_end = random.randint(motif_start, len(seq_b))
+            seq_b = seq_b[:motif_start] + seq_b[motif_start:motif_end].lower().replace('n', 'a') + seq_b[motif_end:]
+        if align_iupac_dna_sequence(seq_a, seq_b, sequence_alignment_object) != \
+                align_iupac_dna_sequence(seq_a, seq_b, vectorized_alignment_object):
+            mismatch_count += 1
+            print("Vectorized mismatch:\n{}\n{}".format(seq_a, seq_b))
+    print("Test 8 - vectorized engine, {} mismatches on random corpus".format(mismatch_count))
+
+    # Test 9 - linear space alignment of long sequences (same score, valid optimal alignment, peak memory)
+    import tracemalloc
+    seq_a = ''.join(random.choice(IUPAC_RNA_BASE) for j in range(0, 2000))
+    seq_b = ''.join(random.choice('NNNNNNACGU') for j in range(0, 2000))
+    tracemalloc.start()
+    full_score = get_best_score(align_iupac_dna_sequence(seq_a, seq_b, vectorized_alignment_object))
+    full_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    tracemalloc.start()
+    linear_score, linear_alignment = align_linear_space(seq_a, seq_b, vectorized_alignment_object)
+    linear_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("Test 9 - linear space alignment: score {} (full matrix {}), alignment score {}, peak memory {:.1f}MB "
+          "(full matrix {:.1f}MB)".format(linear_score, full_score,
+                                          score_alignment(*linear_alignment, vectorized_alignment_object),
+                                          linear_peak / 1e6, full_peak / 1e6))
@@ -16,7 +16,8 @@ import logging
 import shlex
 from typing import List, Dict
 
-from rnafbinv import IUPAC, vienna, sfb_designer
+from rnafbinv import IUPAC, vienna, sfb_designer, rna_structure, parallel, engines, replica_exchange, evolution, \
+    mutator, session, elite, hierarchical
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter, ArgumentDefaultsHelpFormatter, ArgumentTypeError
 
@@ -41,6 +42,32 @@ USAGE_TEXT = """Usage: python3 RNAsfbinvCL [Options]
     --debug : Debug information
     -l <log file path> : Logging information will be written to a given file path (rewrites file if exists)
     --length <length diff> : The resulting sequence size is target structure length +- length diff (default it 0)
+    -w <number of workers> : scores look ahead mutants concurrently on that many RNAfold / alignment workers
+    -n <number of designs> : runs independent designs concurrently (seeds derived from --seed), prints each result
+    --engine <annealing|replica|evolution|hierarchical> : design engine, simulated annealing (default), replica
+                                             exchange, population based evolution (-i sets the number of generations)
+                                             or hierarchical (domains designed separately, then polished)
+    --replicas <number> : number of replica exchange temperatures (default is 4)
+    --swap_interval <number> : iterations between replica swap attempts (default is 10)
+    --population <number> : population size of the evolutionary engine (default is 20)
+    --min_domain <number> : minimum domain length of the hierarchical engine (default is 30)
+    --polish_iter <number> : iterations of the hierarchical engine global polish (default is a quarter of -i)
+    --checkpoint <path> : writes the simulated annealing state every --checkpoint_interval iterations (default 10)
+    --resume <path> : continues a simulated annealing run from a checkpoint
+                      (with -n each design writes / resumes its own file <path>.<design index>)
+    --time_limit <seconds> : wall clock budget of a design, the best sequence so far is returned when it expires
+    --max_folds <number> : RNAfold budget of a design, the best sequence so far is returned when it is spent
+    --schedule <log|linear|adaptive> : simulated annealing cooling schedule (default is log), adaptive follows a
+                                       target acceptance rate curve
+    --reheat <number> : restarts the cooling schedule after that many iterations without a better sequence
+    --schedule_stats <path> : writes per iteration statistics (temperature, acceptance and scores) to a tsv file
+    --score_memo <number> : size of the per design memo of scored sequences (default is 10000, 0 turns it off)
+    --targeted <0-1> : part of the mutations placed by the mismatches of the current alignment (default is 0, uniform)
+    --constrained : mutations keep the target sequence constraints and preserved motifs (replace mutations only)
+    --adaptive_moves : simulated annealing learns the mutation action / size distribution from accepted improvements
+    --block_draws : mutation bases come from pre generated blocks of a per run generator (other results per seed)
+    --elite <number> : simulated annealing keeps and prints up to that many distinct best scored sequences
+    --elite_distance <number> : minimum number of differing bases between elite sequences (default is 3)
     
     -f <input file path> : Path of ini file that includes mandatory information. Some options can also be set via file.
                            command line options take precedence.
@@ -127,6 +154,71 @@ starting_seq_group.add_argument('-r', '--random_start', help="Start simulated an
                                 action="store_true")
 parser.add_argument('--length', help="Maximum variation in result length compared to target structure.", type=int,
                     default=0)
+parser.add_argument('-w', '--workers', help="Number of RNAfold / alignment workers used to score the look ahead "
+                                            "mutants of an iteration concurrently (same result as 1 for a given "
+                                            "seed).", type=int, default=1)
+parser.add_argument('-n', '--num_designs', help="Number of independent designs, each with a seed derived from the "
+                                                "given seed. Designs run concurrently on a process pool (-w sets the "
+                                                "number of processes, default is the number of CPUs).", type=int,
+                    default=1)
+parser.add_argument('--engine', help="Design engine: simulated annealing, replica exchange (parallel tempering), "
+                                    "evolutionary (population based, -i sets the number of generations) or "
+                                    "hierarchical (exterior loop domains designed concurrently, then polished).",
+                    type=str, choices=sorted(engines.ENGINES.keys()), default=engines.DEF_ENGINE)
+parser.add_argument('--replicas', help="Number of replicas (temperatures) used by the replica exchange engine.",
+                    type=int, default=replica_exchange.DEF_REPLICAS)
+parser.add_argument('--swap_interval', help="Iterations between replica swap attempts (replica exchange engine).",
+                    type=int, default=replica_exchange.DEF_SWAP_INTERVAL)
+parser.add_argument('--population', help="Population size of the evolutionary engine.", type=int,
+                    default=evolution.DEF_POPULATION)
+parser.add_argument('--min_domain', help="Minimum length of a domain of the hierarchical engine, shorter exterior "
+                                        "loop branches are designed together with their neighbours.", type=int,
+                    default=hierarchical.DEF_MIN_DOMAIN)
+parser.add_argument('--polish_iter', help="Iterations of the global simulated annealing that polishes the assembled "
+                                          "domains of the hierarchical engine (default is a quarter of -i).", type=int)
+parser.add_argument('--checkpoint', help="Path of a checkpoint file, the simulated annealing state is written to it "
+                                        "every --checkpoint_interval iterations (with -n design i uses <path>.i).",
+                    type=str)
+parser.add_argument('--checkpoint_interval', help="Iterations between checkpoints.", type=int,
+                    default=sfb_designer.DEF_CHECKPOINT_INTERVAL)
+parser.add_argument('--resume', help="Continue a simulated annealing run from a checkpoint file (same result as an "
+                                     "uninterrupted run). Checkpoints keep being written to it unless --checkpoint "
+                                     "is given.", type=str)
+parser.add_argument('--time_limit', help="Wall clock budget of a design in seconds. The cooling schedule follows the "
+                                         "spent budget and the best sequence so far is returned when it expires.",
+                    type=float)
+parser.add_argument('--max_folds', help="Maximum number of RNAfold calls of a design. The cooling schedule follows "
+                                        "the spent budget and the best sequence so far is returned when it is spent.",
+                    type=int)
+parser.add_argument('--schedule', help="Cooling schedule of the simulated annealing engine: logarithmic (default), "
+                                       "linear or adaptive (steers the temperature to a target acceptance rate "
+                                       "curve).", type=str, choices=sorted(sfb_designer.SCHEDULES.keys()),
+                    default=sfb_designer.DEF_SCHEDULE)
+parser.add_argument('--reheat', help="Restart the cooling schedule after this many iterations without a better "
+                                     "sequence (default is off).", type=int)
+parser.add_argument('--schedule_stats', help="Write per iteration statistics of the simulated annealing engine "
+                                             "(temperature, acceptance, current and best score) to this tsv file.",
+                    type=str)
+parser.add_argument('--score_memo', help="Number of scored sequences remembered by a design, a repeated sequence "
+                                         "is not folded again (0 turns the memo off).", type=int,
+                    default=sfb_designer.DEF_SCORE_MEMO_SIZE)
+parser.add_argument('--targeted', help="Part (0 to 1) of the mutations whose position is drawn by how badly it "
+                                       "aligns to the target, the rest are uniform (default is 0).", type=float,
+                    default=mutator.DEF_TARGETED)
+parser.add_argument('--constrained', help="Mutations and random starting bases only use the bases allowed by the "
+                                          "target sequence and never change preserved motifs (-m). Only replace "
+                                          "mutations are proposed.", action="store_true")
+parser.add_argument('--adaptive_moves', help="Reweight the mutation actions (replace / add / remove) and sizes of the "
+                                             "simulated annealing engine by their rate of accepted improvements.",
+                    action="store_true")
+parser.add_argument('--block_draws', help="Draw the bases of mutations and random starts from pre generated blocks of "
+                                          "a per run generator (seeded by --seed, results differ from the default "
+                                          "draws).", action="store_true")
+parser.add_argument('--elite', help="Number of distinct best scored sequences kept from the simulated annealing run "
+                                    "and printed with the result (default is 0, off).", type=int, default=0)
+parser.add_argument('--elite_distance', help="Minimum distance (differing bases) between two elite sequences, of "
+                                             "closer sequences only the better one is kept.", type=int,
+                    default=elite.DEF_ELITE_DISTANCE)
 parser.add_argument('-f', dest='input_file', help='Path of ini file that includes mandatory information. Some options '
                                                   'can also be set via file. command line options take precedence.',
                     type=str)
@@ -193,6 +285,50 @@ def generate_arg_map(argv):
     arg_map['seq_motif'] = auto_parse.seq_motif
     # --reduced_bi
     arg_map['reduced_bi'] = auto_parse.reduced_bi
+    # -w <number of scoring workers>
+    arg_map['workers'] = auto_parse.workers
+    # -n <number of designs>
+    arg_map['num_designs'] = auto_parse.num_designs
+    # --engine <engine name>, --replicas <number of replicas>, --swap_interval <iterations>
+    arg_map['engine'] = auto_parse.engine
+    arg_map['replicas'] = auto_parse.replicas
+    arg_map['swap_interval'] = auto_parse.swap_interval
+    # --population <population size>
+    arg_map['population'] = auto_parse.population
+    # --min_domain <domain length>, --polish_iter <iterations>
+    arg_map['min_domain'] = auto_parse.min_domain
+    if auto_parse.polish_iter is not None:
+        arg_map['polish_iter'] = auto_parse.polish_iter
+    # --checkpoint <path>, --checkpoint_interval <iterations>, --resume <path>
+    arg_map['checkpoint_interval'] = auto_parse.checkpoint_interval
+    if auto_parse.resume is not None:
+        arg_map['resume'] = auto_parse.resume
+    if auto_parse.checkpoint is not None or auto_parse.resume is not None:
+        arg_map['checkpoint'] = auto_parse.checkpoint if auto_parse.checkpoint is not None else auto_parse.resume
+    # --time_limit <seconds>, --max_folds <number of folds>
+    if auto_parse.time_limit is not None:
+        arg_map['time_limit'] = auto_parse.time_limit
+    if auto_parse.max_folds is not None:
+        arg_map['max_folds'] = auto_parse.max_folds
+    # --schedule <schedule name>, --reheat <iterations>, --schedule_stats <path>
+    arg_map['schedule'] = auto_parse.schedule
+    if auto_parse.reheat is not None:
+        arg_map['reheat'] = auto_parse.reheat
+    if auto_parse.schedule_stats is not None:
+        arg_map['schedule_stats'] = auto_parse.schedule_stats
+    # --score_memo <memo size>
+    arg_map['score_memo_size'] = auto_parse.score_memo
+    # --targeted <targeted mutation part>
+    arg_map['targeted'] = min(max(auto_parse.targeted, 0.0), 1.0)
+    # --constrained
+    arg_map['constrained'] = auto_parse.constrained
+    # --adaptive_moves
+    arg_map['adaptive_moves'] = auto_parse.adaptive_moves
+    # --block_draws
+    arg_map['block_draws'] = auto_parse.block_draws
+    # --elite <archive size>, --elite_distance <minimum distance>
+    arg_map['elite_size'] = auto_parse.elite
+    arg_map['elite_distance'] = auto_parse.elite_distance
     # -o <output log file> TODO: replace
     # item_index = index('-o')
     # if item_index is not None:
@@ -216,17 +352,7 @@ def generate_arg_map(argv):
 
 # check for valid basic (only '( 'and ')' for brackets) dot bracket structure
 def is_valid_structure(structure):
-    bracket_count = 0
-    for c in structure:
-        if c == '(':
-            bracket_count += 1
-        elif c == ')':
-            bracket_count -= 1
-            if bracket_count < 0:
-                return False
-        elif c != '.':
-            return False
-    return bracket_count == 0
+    return rna_structure.is_valid(structure)
 
 
 # changes any type of bracket that isn't round brackets into one
@@ -391,29 +517,55 @@ def designer(argv: List[str]) -> sfb_designer.RnafbinvResult:
     error = arg_map.get('error')
     if error is not None:
         usage(error)
+    elif arg_map.get('num_designs', 1) > 1:
+        # sequence motif uses lower case sequence for higher penalty in insertion / deletion
+        if not arg_map['seq_motif']:
+            arg_map['target_sequence'] = arg_map['target_sequence'].upper()
+        result = multi_designer(arg_map)
     else:
         arg_map.get("logger").debug("Argument map:\n{}".format(arg_map))
         # init RNAfold
         rna_folder = vienna.LiveRNAfold(arg_map.get("logger"))
         rna_folder.start(arg_map.get('circular'))
         arg_map['RNAfold'] = rna_folder
+        # concurrent look ahead scoring
+        if arg_map.get('workers', 1) > 1:
+            arg_map['scorer'] = parallel.CandidateScorer(arg_map['workers'], arg_map.get('circular'),
+                                                         arg_map.get("logger"))
         # sequence motif uses lower case sequence for higher penalty in insertion / deletion
         if not arg_map['seq_motif']:
             arg_map['target_sequence'] = arg_map['target_sequence'].upper()
-        # run simulated annealing
-        arg_map.get("logger").debug("Starting simulated_annealing\nArguments: {}".format(arg_map))
-        designed_sequence = sfb_designer.simulated_annealing(arg_map)
-        arg_map.get("logger").debug("Finished simulated_annealing\nSequence: {}".format(designed_sequence))
+        # run the design engine (simulated annealing by default)
+        arg_map.get("logger").debug("Starting {}\nArguments: {}".format(arg_map.get('engine'), arg_map))
+        design_session = session.DesignSession(arg_map, folder=rna_folder)
+        designed_sequence = design_session.run()
+        arg_map.get("logger").debug("Finished {}\nSequence: {}".format(arg_map.get('engine'), designed_sequence))
         if designed_sequence is not None:
             logging.info("Finished simulated annealing, resulting sequence: {}".format(designed_sequence))
-            result = sfb_designer.generate_res_object(designed_sequence, arg_map)
+            result = design_session.result(designed_sequence)
             print(str(result))
         else:
             logging.error("Failed to design, Exisiting!")
+        if arg_map.get('scorer') is not None:
+            arg_map['scorer'].close()
         rna_folder.close()
     return result
 
 
+# Runs arg_map['num_designs'] designs on a process pool, prints results as they finish and returns the best scoring one
+def multi_designer(arg_map: Dict) -> sfb_designer.RnafbinvResult:
+    best_result = None
+    processes = arg_map['workers'] if arg_map.get('workers', 1) > 1 else None
+    for design_index, seed, result in parallel.design_many(arg_map, arg_map['num_designs'], processes):
+        if result is None:
+            logging.error("Design {} (seed {}) failed".format(design_index + 1, seed))
+        else:
+            print("Design {} (seed {}):\n{}".format(design_index + 1, seed, str(result)))
+            if best_result is None or result.score < best_result.score:
+                best_result = result
+    return best_result
+
+
 def main(command_line_args: str) -> sfb_designer.RnafbinvResult:
     return designer(shlex.split(command_line_args))
 
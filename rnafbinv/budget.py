@@ -0,0 +1,84 @@
+'''
+Wall clock / fold budget of a single design.
+Engines stop when the budget expires and return the best sequence found so far, the cooling schedule follows the
+spent part of the budget.
+'''
+
+import time
+from typing import Any, Dict
+
+
+class DesignBudget:
+    # time_limit in seconds, max_folds in RNAfold calls, None means unlimited
+    def __init__(self, time_limit: float = None, max_folds: int = None):
+        self.time_limit = time_limit
+        self.max_folds = max_folds
+        self.start_time = time.monotonic()
+        self.folds = 0
+        self.expired_early = False
+
+    def __str__(self):
+        return "{:.2f}s{} {} folds{}{}".format(self.elapsed(),
+                                              '' if self.time_limit is None else ' of {}s'.format(self.time_limit),
+                                              self.folds,
+                                              '' if self.max_folds is None else ' of {}'.format(self.max_folds),
+                                              ' (expired)' if self.expired_early else '')
+
+    def is_limited(self) -> bool:
+        return self.time_limit is not None or self.max_folds is not None
+
+    def add_folds(self, count: int = 1):
+        self.folds += count
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start_time
+
+    # spent part of the budget (the larger of time and folds), 0 when unlimited
+    def fraction(self) -> float:
+        fraction = 0.0
+        if self.time_limit is not None:
+            fraction = max(fraction, self.elapsed() / self.time_limit if self.time_limit > 0 else 1.0)
+        if self.max_folds is not None:
+            fraction = max(fraction, self.folds / self.max_folds if self.max_folds > 0 else 1.0)
+        return min(fraction, 1.0)
+
+    def remaining_folds(self):
+        if self.max_folds is None:
+            return None
+        return max(0, self.max_folds - self.folds)
+
+    def expired(self) -> bool:
+        if self.is_limited() and self.fraction() >= 1.0:
+            self.expired_early = True
+        return self.expired_early
+
+
+# Creates the budget of a design run from options['time_limit'] / options['max_folds'] and stores it in
+# options['budget']
+def start_budget(options: Dict[str, Any]) -> DesignBudget:
+    design_budget = DesignBudget(options.get('time_limit'), options.get('max_folds'))
+    options['budget'] = design_budget
+    return design_budget
+
+
+# The budget of the running design (options['budget']), started here if the engine is called directly
+def get_budget(options: Dict[str, Any]) -> DesignBudget:
+    design_budget = options.get('budget')
+    if design_budget is None:
+        design_budget = start_budget(options)
+    return design_budget
+
+
+def count_folds(options: Dict[str, Any], count: int = 1):
+    design_budget = options.get('budget')
+    if design_budget is not None:
+        design_budget.add_folds(count)
+
+
+# The iteration used for the temperature: the loop iteration or, when the budget is spent faster, the same part of
+# max_iteration as the spent part of the budget
+def budget_iteration(iteration: int, max_iteration: int, options: Dict[str, Any]) -> int:
+    design_budget = options.get('budget')
+    if design_budget is None or not design_budget.is_limited():
+        return iteration
+    return max(iteration, int(design_budget.fraction() * max_iteration))
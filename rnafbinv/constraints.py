@@ -0,0 +1,42 @@
+'''
+Sequence constraints compiled from the target sequence and the preserved motifs of the target tree.
+Used by the mutator and the random starting sequence (opt in, options['constrained']) so no proposal breaks a fixed
+or restricted base or changes a preserved motif.
+'''
+
+from typing import List
+
+from rnafbinv import IUPAC, shapiro_tree_aligner, tree_aligner
+
+
+class SequenceConstraints:
+    # allowed[i] holds the RNA bases allowed at target position i, protected holds the (start, end) ranges of
+    # preserved motifs (never mutated)
+    def __init__(self, allowed: List[str], protected):
+        self.allowed = tuple(allowed)
+        self.protected = tuple(protected)
+        self.is_protected = [False] * len(self.allowed)
+        for start, end in self.protected:
+            for index in range(start, end):
+                self.is_protected[index] = True
+
+    def __len__(self):
+        return len(self.allowed)
+
+    def __str__(self):
+        return "{} fixed positions, {} restricted positions, protected ranges: {}".format(
+            sum(1 for bases in self.allowed if len(bases) == 1),
+            sum(1 for bases in self.allowed if 1 < len(bases) < len(IUPAC.IUPAC_RNA_BASE)), self.protected)
+
+    def applies_to(self, sequence: str) -> bool:
+        return len(sequence) == len(self.allowed)
+
+    # positions a mutation may start at: not protected and with another allowed base (or breaking its constraint)
+    def mutable_indexes(self, sequence: str) -> List[int]:
+        return [index for index, bases in enumerate(self.allowed)
+                if not self.is_protected[index] and (len(bases) > 1 or sequence[index] not in bases)]
+
+
+def compile_constraints(target_sequence: str, target_tree: tree_aligner.Tree) -> SequenceConstraints:
+    allowed = [IUPAC.IUPAC_XNA_MAP.get(c, IUPAC.IUPAC_RNA_BASE).replace('T', '') for c in target_sequence.upper()]
+    return SequenceConstraints(allowed, shapiro_tree_aligner.get_preserved_ranges(target_tree))
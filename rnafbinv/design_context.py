@@ -0,0 +1,77 @@
+'''
+Per target design state, computed once: alignment rules, parsed target structure, target tree with the preserved
+motifs, its optimal (self alignment) score and the sequence constraints.
+A context is shared by every design of the same target (seeds, sessions, threads) and is picklable so it can be sent
+to design worker processes.
+'''
+
+from typing import Any, Dict, List
+
+from rnafbinv import shapiro_tree_aligner, shapiro_generator, tree_aligner, rna_structure, constraints
+
+
+# Marks the target tree nodes of motifs (dicts of index, name and length) as preserved.
+# Returns False if a motif does not match its node.
+def merge_motifs(target_tree: tree_aligner.Tree, motifs: List[Dict[str, Any]]) -> bool:
+    # first motif of each index wins
+    motif_map = {motif.get('index'): motif for motif in reversed(motifs or [])}
+    if not motif_map:
+        return True
+    tree_stack = [target_tree]
+    index = 0
+    while tree_stack:
+        top = tree_stack.pop()
+        for child in top.children[::-1]:
+            tree_stack.append(child)
+        found_motif = motif_map.get(index)
+        if found_motif is not None:
+            if top.value.size == found_motif.get('length') and \
+                    top.value.name == found_motif.get('name'):
+                top.value.preserve = True
+            else:
+                return False
+        index += 1
+    return True
+
+
+# Identifies the target of a context, the options it is built from
+def context_key(options: Dict[str, Any]) -> tuple:
+    motifs = tuple((motif.get('index'), motif.get('name'), motif.get('length'))
+                   for motif in options.get('motifs') or [])
+    return (options['target_structure'], options['target_sequence'], motifs, options.get('reduced_bi', 0),
+            bool(options.get('constrained')))
+
+
+class DesignContext:
+    # Raises ValueError if the motifs do not match the target structure
+    def __init__(self, target_structure: str, target_sequence: str, motifs: List[Dict[str, Any]] = None,
+                 reduced_bi: int = 0, constrained: bool = False):
+        self.target_structure = target_structure
+        self.target_sequence = target_sequence
+        self.key = context_key({'target_structure': target_structure, 'target_sequence': target_sequence,
+                                'motifs': motifs, 'reduced_bi': reduced_bi, 'constrained': constrained})
+        self.structure = rna_structure.get_structure(target_structure)
+        # node alignments are only generated for the final aligned tree
+        self.alignment_rules = shapiro_tree_aligner.get_alignment_rules(reduced_bi, score_only=True)
+        self.target_tree = shapiro_tree_aligner.get_tree(target_structure, target_sequence)
+        if not merge_motifs(self.target_tree, motifs):
+            raise ValueError('Motif list does not match target structure {}\nTarget Shapiro:{}'.format(
+                motifs, shapiro_generator.get_shapiro(target_structure).shapiro))
+        # results are reported against the target tree without preserved motifs
+        self.result_tree = shapiro_tree_aligner.get_tree(target_structure, target_sequence)
+        _, self.optimal_score = shapiro_tree_aligner.align_trees(self.target_tree, self.target_tree,
+                                                                 self.alignment_rules)
+        # opt in sequence constraints of the mutator / random starting sequence
+        self.constraints = constraints.compile_constraints(target_sequence, self.target_tree) if constrained else None
+
+    def __str__(self):
+        return "target length {}, optimal score {}, constraints: {}".format(len(self.target_structure),
+                                                                            self.optimal_score, self.constraints)
+
+    @classmethod
+    def from_options(cls, options: Dict[str, Any]) -> 'DesignContext':
+        return cls(options['target_structure'], options['target_sequence'], options.get('motifs'),
+                   options.get('reduced_bi', 0), options.get('constrained', False))
+
+    def matches(self, options: Dict[str, Any]) -> bool:
+        return self.key == context_key(options)
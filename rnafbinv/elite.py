@@ -0,0 +1,98 @@
+'''
+Bounded archive of the best distinct sequences scored by a design (opt in, options['elite_size']).
+A sequence enters the archive if it is at least as good as every archived sequence closer to it than min_distance
+(those are replaced), so one annealing chain yields several diverse designs for its fold budget. Ties go to the latest
+sequence, as the best sequence of the annealing loop does.
+'''
+
+from typing import Any, Dict, List, Tuple
+
+DEF_ELITE_DISTANCE = 3
+
+
+# Hamming distance for sequences of the same length, edit distance otherwise (variable length designs)
+def sequence_distance(sequence_one: str, sequence_two: str) -> int:
+    if len(sequence_one) == len(sequence_two):
+        return sum(1 for base_one, base_two in zip(sequence_one, sequence_two) if base_one != base_two)
+    previous = list(range(len(sequence_two) + 1))
+    for i, base_one in enumerate(sequence_one, 1):
+        current = [i]
+        for j, base_two in enumerate(sequence_two, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (base_one != base_two)))
+        previous = current
+    return previous[-1]
+
+
+class EliteArchive:
+    # size is the maximum number of sequences, sequences closer than min_distance compete for one place
+    def __init__(self, size: int, min_distance: int = DEF_ELITE_DISTANCE):
+        self.size = size
+        self.min_distance = min_distance
+        # (score, sequence) best first, the latest added first among equal scores
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return "{} of {} (min distance {}), scores: {}".format(len(self.entries), self.size, self.min_distance,
+                                                             [score for score, _ in self.entries])
+
+    def add(self, sequence: str, score) -> bool:
+        if self.size <= 0 or (len(self.entries) >= self.size and score > self.entries[-1][0]):
+            return False
+        close = []
+        for index, (entry_score, entry_sequence) in enumerate(self.entries):
+            if sequence_distance(sequence, entry_sequence) < self.min_distance:
+                if entry_score < score:
+                    return False
+                close.append(index)
+        for index in reversed(close):
+            del self.entries[index]
+        position = len(self.entries)
+        while position > 0 and self.entries[position - 1][0] >= score:
+            position -= 1
+        self.entries.insert(position, (score, sequence))
+        del self.entries[self.size:]
+        return True
+
+    # [(sequence, score)] best first
+    def designs(self) -> List[Tuple[str, Any]]:
+        return [(sequence, score) for score, sequence in self.entries]
+
+    def get_state(self) -> Dict[str, Any]:
+        return {'size': self.size, 'min_distance': self.min_distance, 'entries': self.entries}
+
+    def set_state(self, state: Dict[str, Any]):
+        self.size = state['size']
+        self.min_distance = state['min_distance']
+        self.entries = [(score, sequence) for score, sequence in state['entries']]
+
+
+if __name__ == "__main__":
+    # TEST tied scores: the latest sequence wins a tie, as in the annealing loop
+    test_archive = EliteArchive(2)
+    test_archive.add('AAAAAAAAAA', 5)
+    print("Close tie replaces: {}".format(test_archive.add('AAAAAAAAAC', 5) and
+                                          test_archive.designs() == [('AAAAAAAAAC', 5)]))
+    test_archive.add('CCCCCCCCCC', 5)
+    print("Distant tie first: {}".format(test_archive.designs() == [('CCCCCCCCCC', 5), ('AAAAAAAAAC', 5)]))
+    print("Full archive tie drops the oldest: {}".format(test_archive.add('GGGGGGGGGG', 5) and
+                                                         test_archive.designs() == [('GGGGGGGGGG', 5),
+                                                                                    ('CCCCCCCCCC', 5)]))
+    print("Worse rejected: {}".format(not test_archive.add('UUUUUUUUUU', 6)))
+    # TEST designs: the returned design heads the archive (the linear schedule ends at temperature 0, where a tied
+    # candidate is scored and archived but not accepted)
+    import logging
+    from rnafbinv import session
+    logging.basicConfig(level=logging.WARNING)
+    test_structure = '((((((((...(.(((((.......))))).)........((((((.......))))))..))))))))'
+    for test_seed in (1, 2, 3):
+        test_options = {'logger': logging.getLogger('RNAsfbinv'), 'fold': 'MFE', 'look_ahead': 4, 'circular': False,
+                        'motifs': [], 'random': True, 'vlength': 0, 'seq_motif': False, 'reduced_bi': 0, 'iter': 80,
+                        'schedule': 'linear', 'elite_size': 3, 'target_structure': test_structure,
+                        'target_sequence': 'N' * len(test_structure)}
+        with session.DesignSession(test_options, test_seed) as design_session:
+            test_sequence = design_session.run()
+            print("Seed {} returned design heads the archive: {}".format(
+                test_seed, design_session.options['elite'].designs()[0][0] == test_sequence))
@@ -0,0 +1,23 @@
+'''
+Available design engines, all take the options map and return the designed sequence (None on failure / stop).
+'''
+
+from typing import Any, Dict
+
+from rnafbinv import sfb_designer, replica_exchange, evolution, hierarchical, budget
+
+DEF_ENGINE = 'annealing'
+ENGINES = {
+    'annealing': sfb_designer.simulated_annealing,
+    'replica': replica_exchange.replica_exchange,
+    'evolution': evolution.evolutionary_design,
+    'hierarchical': hierarchical.hierarchical_design,
+}
+
+
+# runs the engine selected by options['engine'] (simulated annealing by default) with a new design budget
+# (options['time_limit'] / options['max_folds'], see budget.DesignBudget) and visited sequence memo
+def run_engine(options: Dict[str, Any]):
+    budget.start_budget(options)
+    sfb_designer.start_score_memo(options)
+    return ENGINES[options.get('engine', DEF_ENGINE)](options)
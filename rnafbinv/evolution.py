@@ -0,0 +1,90 @@
+'''
+Population based (evolutionary) design engine.
+Each generation is built by tournament selection, crossover at shapiro motif boundaries of the parent match tree and
+multi point mutations (mutator.perturbate), then scored as a single batch (sfb_designer.score_batch).
+'''
+
+import random
+from typing import Any, Dict, List, Tuple
+
+from rnafbinv import sfb_designer, mutator, shapiro_tree_aligner, tree_aligner, budget
+
+DEF_POPULATION = 20
+TOURNAMENT_SIZE = 3
+CROSSOVER_RATE = 0.7
+
+# (sequence, match tree, score)
+Individual = Tuple[str, tree_aligner.Tree, float]
+
+
+def tournament_select(population: List[Individual], size: int = TOURNAMENT_SIZE, rng=random) -> Individual:
+    return min(rng.sample(population, min(size, len(population))), key=lambda individual: individual[2])
+
+
+# Single point crossover, the cut is a motif start / end of the first parent that lies inside both parents
+def motif_crossover(parent_one: Individual, parent_two: Individual, rng=random) -> str:
+    sequence_one, match_tree, _ = parent_one
+    sequence_two = parent_two[0]
+    cuts = [boundary for boundary in shapiro_tree_aligner.get_motif_boundaries(match_tree)
+            if 0 < boundary < min(len(sequence_one), len(sequence_two))]
+    if not cuts:
+        return sequence_one
+    cut = rng.choice(cuts)
+    return sequence_one[:cut] + sequence_two[cut:]
+
+
+# Same input / output as sfb_designer.simulated_annealing: options['iter'] generations of options['population']
+# sequences, the best sequence is always kept (elitism).
+def evolutionary_design(options: Dict[str, Any]):
+    if len(options) == 0:
+        options.get('logger').fatal("Options object was not properly initiated. ")
+        return None
+    design_start = sfb_designer.initialize_design(options)
+    if design_start is None:
+        return None
+    current_sequence, target_tree = design_start
+    design_budget = budget.get_budget(options)
+    rng = mutator.get_random(options)
+    no_generations = options.get('iter')
+    population_size = max(2, options.get('population', DEF_POPULATION))
+    # initial population: the starting sequence and mutants of it
+    match_tree, current_score = sfb_designer.score_sequence(current_sequence, target_tree, options)
+    sequences = [mutator.perturbate(current_sequence, match_tree, options) for _ in range(1, population_size)]
+    population = [(current_sequence, match_tree, current_score)] + \
+        [(sequence, tree, score) for sequence, (tree, score) in
+         zip(sequences, sfb_designer.score_batch(sequences, target_tree, options))]
+    best = min(population, key=lambda individual: individual[2])
+    options.get('logger').info('Initial population best ({}): {}'.format(best[2], best[0]))
+    updater = options.get('updater')
+    for generation in range(0, no_generations):
+        if options.get('stop') is not None:
+            return None
+        if best[2] == 0:
+            break
+        if design_budget.expired():
+            options.get('logger').info('Budget expired at generation {}: {}'.format(generation + 1, design_budget))
+            break
+        no_children = population_size - 1
+        remaining_folds = design_budget.remaining_folds()
+        if remaining_folds is not None:
+            no_children = max(1, min(no_children, remaining_folds))
+        sequences = []
+        for _ in range(0, no_children):
+            parent = tournament_select(population, rng=rng)
+            child = parent[0]
+            if rng.random() < CROSSOVER_RATE:
+                child = motif_crossover(parent, tournament_select(population, rng=rng), rng)
+            sequences.append(mutator.perturbate(child, parent[1], options))
+        population = [best] + [(sequence, tree, score) for sequence, (tree, score) in
+                               zip(sequences, sfb_designer.score_batch(sequences, target_tree, options))]
+        generation_best = min(population, key=lambda individual: individual[2])
+        if generation_best[2] < best[2]:
+            best = generation_best
+        options.get('logger').debug('Generation {} best ({}): {}\nAlign tree: {}'.format(generation + 1, best[2],
+                                                                                       best[0], best[1]))
+        if updater is not None:
+            updater.update(generation + 1)
+    options.get('logger').info('Budget spent: {}'.format(design_budget))
+    if options.get('score_memo') is not None:
+        options.get('logger').info('Visited sequence memo: {}'.format(options['score_memo']))
+    return best[0]
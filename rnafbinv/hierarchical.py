@@ -0,0 +1,167 @@
+'''
+Hierarchical (divide and conquer) design engine for long multi domain targets.
+The target is split at the exterior loop branches (children of the shapiro root / E node) into domains of at least
+options['min_domain'] bases. Each domain is designed by simulated annealing with its slice of target_sequence in its
+own run (threads of this process, each with its own random generator and RNAfold), the designed domains are assembled
+with random exterior loop linkers and the assembly is polished by a short global simulated annealing
+(options['polish_iter']).
+Motifs, target energy and target neutrality only apply to the global polish.
+'''
+
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+from rnafbinv import sfb_designer, rna_structure, mutator, budget, vienna
+
+DEF_MIN_DOMAIN = 30
+DEF_POLISH_PART = 0.25
+# part of a time / fold budget given to the domain designs, the polish gets the rest
+DOMAIN_BUDGET_PART = 0.8
+# options of the global target and run state of the design that are not passed to the domain designs (the domain
+# threads share the logger)
+GLOBAL_OPTIONS = ('RNAfold', 'scorer', 'updater', 'stop', 'budget', 'score_memo', 'random_generator', 'session',
+                  'moves', 'base_draws', 'alignment_rules', 'constraints', 'mismatch_weights', 'elite', 'motifs',
+                  'target_energy', 'target_neutrality', 'starting_sequence', 'checkpoint', 'resume', 'schedule_stats',
+                  'design_context', 'elite_size')
+# options of the polish run that are not copied back to the design options
+POLISH_OPTIONS = ('iter', 'starting_sequence', 'exact_start', 'random', 'updater', 'stop', 'rng')
+
+
+# (start, end) ranges of the domains: consecutive exterior loop branches are grouped until a group spans min_domain
+# bases, a short last group joins the one before it. Exterior loop bases between domains are not part of any domain.
+def get_domains(target_structure: str, min_domain: int = DEF_MIN_DOMAIN) -> List[Tuple[int, int]]:
+    structure = rna_structure.get_structure(target_structure)
+    domains = []
+    for helix_index in structure.exterior_loop[1]:
+        start, end, _ = structure.helices[helix_index]
+        if domains and domains[-1][1] - domains[-1][0] < min_domain:
+            domains[-1] = (domains[-1][0], end + 1)
+        else:
+            domains.append((start, end + 1))
+    if len(domains) > 1 and domains[-1][1] - domains[-1][0] < min_domain:
+        last_start, last_end = domains.pop()
+        domains[-1] = (domains[-1][0], last_end)
+    return domains
+
+
+# options['updater'] of a run started by the engine, passes on a stop request of the design options and reports
+# progress to updater
+class _StopRelay:
+    def __init__(self, options: Dict[str, Any], run_options: Dict[str, Any], updater=None):
+        self.options = options
+        self.run_options = run_options
+        self.updater = updater
+
+    def update(self, iteration: int):
+        if self.options.get('stop') is not None:
+            sfb_designer.stop(self.run_options)
+        if self.updater is not None:
+            self.updater.update(iteration)
+
+
+def _domain_options(options: Dict[str, Any], start: int, end: int, domain_length: int) -> Dict[str, Any]:
+    domain_options = {key: value for key, value in options.items() if key not in GLOBAL_OPTIONS}
+    domain_options['target_structure'] = options['target_structure'][start:end]
+    domain_options['target_sequence'] = options['target_sequence'][start:end]
+    domain_options['vlength'] = 0
+    starting_sequence = options.get('starting_sequence')
+    if starting_sequence is not None and len(starting_sequence) == len(options['target_structure']):
+        domain_options['starting_sequence'] = starting_sequence[start:end]
+    if options.get('time_limit') is not None:
+        domain_options['time_limit'] = options['time_limit'] * DOMAIN_BUDGET_PART
+    if options.get('max_folds') is not None:
+        domain_options['max_folds'] = max(1, int(options['max_folds'] * DOMAIN_BUDGET_PART * (end - start) /
+                                                 domain_length))
+    return domain_options
+
+
+# Simulated annealing of a domain, returns (designed sequence or None, number of folds)
+def _design_domain(domain_options: Dict[str, Any], seed: int, options: Dict[str, Any]):
+    domain_options['rng'] = seed
+    domain_options['random_generator'] = random.Random(seed)
+    domain_options['updater'] = _StopRelay(options, domain_options)
+    rna_folder = vienna.LiveRNAfold(domain_options.get('logger'))
+    rna_folder.start(domain_options.get('circular', False))
+    domain_options['RNAfold'] = rna_folder
+    try:
+        budget.start_budget(domain_options)
+        sfb_designer.start_score_memo(domain_options)
+        designed_sequence = sfb_designer.simulated_annealing(domain_options)
+    finally:
+        rna_folder.close()
+    return designed_sequence, domain_options['budget'].folds
+
+
+# Short global simulated annealing from the assembled sequence (or the checkpoint of options['resume']), continues
+# the random stream of the design. The run state (elite archive, constraints, ...) is kept in options.
+def _polish(options: Dict[str, Any], assembled: str):
+    polish_options = dict(options)
+    polish_options['iter'] = options.get('polish_iter', max(1, int(options.get('iter') * DEF_POLISH_PART)))
+    polish_options['starting_sequence'] = assembled
+    polish_options['exact_start'] = True
+    polish_options['random'] = False
+    polish_options['updater'] = _StopRelay(options, polish_options, options.get('updater'))
+    polish_options.pop('rng', None)
+    polish_options.pop('stop', None)
+    designed_sequence = sfb_designer.simulated_annealing(polish_options)
+    options.update({key: value for key, value in polish_options.items() if key not in POLISH_OPTIONS})
+    return designed_sequence
+
+
+# Same input / output as sfb_designer.simulated_annealing. Targets with less than two domains are designed by
+# simulated annealing as a whole.
+def hierarchical_design(options: Dict[str, Any]):
+    if len(options) == 0:
+        options.get('logger').fatal("Options object was not properly initiated. ")
+        return None
+    if options.get('resume') is not None:
+        return _polish(options, None)
+    domains = get_domains(options['target_structure'], options.get('min_domain', DEF_MIN_DOMAIN))
+    if len(domains) < 2 or options.get('vlength', 0) != 0:
+        return sfb_designer.simulated_annealing(options)
+    rng = mutator.get_random(options)
+    if options.get('rng') is not None:
+        rng.seed(options['rng'])
+    seeds = [rng.getrandbits(32) for _ in domains]
+    options.get('logger').info('Designing {} domains: {}'.format(len(domains), domains))
+    # domain designs
+    domain_length = sum(end - start for start, end in domains)
+    with ThreadPoolExecutor(max_workers=min(len(domains), os.cpu_count() or 1)) as executor:
+        futures = [executor.submit(_design_domain, _domain_options(options, start, end, domain_length), seed, options)
+                   for (start, end), seed in zip(domains, seeds)]
+        domain_results = [future.result() for future in futures]
+    if options.get('stop') is not None:
+        return None
+    design_budget = budget.get_budget(options)
+    design_budget.add_folds(sum(folds for _, folds in domain_results))
+    # assembly, linkers (and failed domains) start as random bases
+    target_sequence = options['target_sequence'].replace('T', 'U')
+    assembled = list(sfb_designer.generate_random_start(len(options['target_structure']), target_sequence, rng=rng))
+    for (start, end), (designed_sequence, _) in zip(domains, domain_results):
+        if designed_sequence is None:
+            options.get('logger').warning('Domain {}-{} failed, polishing a random domain'.format(start, end))
+        else:
+            assembled[start:end] = designed_sequence
+    assembled = ''.join(assembled)
+    options.get('logger').info('Assembled sequence: {}'.format(assembled))
+    return _polish(options, assembled)
+
+
+if __name__ == "__main__":
+    import logging
+    from rnafbinv import session
+    logging.basicConfig(level=logging.WARNING)
+    # TEST multi domain design: three exterior loop branches, each designed as its own domain
+    test_structure = '...((((((((...(.(((((.......))))).)........((((((.......))))))..)))))))).....((((((....))))))' \
+                     '....((((((((...(.(((((.......))))).)........((((((.......))))))..))))))))..'
+    test_options = {'logger': logging.getLogger('RNAsfbinv'), 'fold': 'MFE', 'look_ahead': 4, 'circular': False,
+                    'motifs': [], 'random': True, 'vlength': 0, 'seq_motif': False, 'reduced_bi': 0, 'iter': 20,
+                    'engine': 'hierarchical', 'min_domain': 10, 'target_structure': test_structure,
+                    'target_sequence': 'N' * len(test_structure)}
+    print("Domains: {}".format(get_domains(test_structure, test_options['min_domain'])))
+    with session.DesignSession(test_options, 5) as design_session:
+        test_sequence = design_session.run()
+    print("Designed sequence: {}".format(test_sequence))
+    print("Designed full length: {}".format(test_sequence is not None and len(test_sequence) == len(test_structure)))
@@ -0,0 +1,66 @@
+'''
+Bounded memo (least recently used eviction) with hit counters.
+Used to skip repeated work such as aligning the same sequence segments over and over.
+'''
+
+import threading
+from collections import OrderedDict
+
+
+class LRUMemo:
+    def __init__(self, max_size: int = 10000, enabled: bool = True):
+        self.max_size = max_size
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __str__(self):
+        return "size {}/{} hits {} misses {} evictions {}{}".format(len(self), self.max_size, self.hits, self.misses,
+                                                                   self.evictions, '' if self.enabled else ' (off)')
+
+    # returns the stored value or None if missing (or memo is disabled)
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if not self.enabled or self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def resize(self, max_size: int):
+        with self._lock:
+            self.max_size = max_size
+            while len(self._items) > max(self.max_size, 0):
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self, reset_counters: bool = False):
+        with self._lock:
+            self._items.clear()
+            if reset_counters:
+                self.hits = 0
+                self.misses = 0
+                self.evictions = 0
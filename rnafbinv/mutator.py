@@ -4,8 +4,9 @@ enter description
 '''
 
 import random
-from rnafbinv import IUPAC, tree_aligner
-from typing import Dict, Any
+import numpy as np
+from rnafbinv import IUPAC, tree_aligner, shapiro_tree_aligner, constraints
+from typing import Dict, Any, List
 import enum
 
 '''
@@ -21,26 +22,238 @@ class Action(enum.Enum):
     REMOVE = 3
 
 
+DEF_TARGETED = 0.0
+
+
+# Random generator of the running design (options['random_generator'], see session.DesignSession), the random module
+# if there is none
+def get_random(options: Dict[str, Any]):
+    generator = options.get('random_generator')
+    return generator if generator is not None else random
+
+
+BASE_BYTES = IUPAC.IUPAC_RNA_BASE.encode('ascii')
+DRAW_BLOCK_SIZE = 4096
+# draws are uniform in [0, DRAW_RANGE), a multiple of every choice size up to 4 bases
+DRAW_RANGE = 12
+# draw -> base (ascii code)
+DRAW_TO_BASE = bytes([BASE_BYTES[draw % len(BASE_BYTES)] for draw in range(256)])
+
+
+# Base draws of a design run (opt in, options['base_draws']): blocks of pre generated draws from a numpy Generator
+# seeded per run. Mutants are built on ascii bytearrays and decoded once for the folding engine.
+class BaseDraws:
+    def __init__(self, seed: int, block_size: int = DRAW_BLOCK_SIZE):
+        self.block_size = block_size
+        self._generator = np.random.default_rng(seed)
+        self._block = b''
+        self._position = 0
+
+    def _refill(self, count: int):
+        self._block = self._generator.integers(0, DRAW_RANGE, size=max(self.block_size, count),
+                                               dtype=np.uint8).tobytes()
+        self._position = 0
+
+    def _draws(self, count: int) -> bytes:
+        if self._position + count > len(self._block):
+            self._refill(count)
+        draws = self._block[self._position:self._position + count]
+        self._position += count
+        return draws
+
+    def _draw(self) -> int:
+        if self._position >= len(self._block):
+            self._refill(1)
+        draw = self._block[self._position]
+        self._position += 1
+        return draw
+
+    # count uniform random bases (ascii bytes)
+    def bases(self, count: int) -> bytes:
+        return self._draws(count).translate(DRAW_TO_BASE)
+
+    # a base (ascii code) other than base
+    def other_base(self, base: int) -> int:
+        base_index = BASE_BYTES.find(base)
+        draw = self._draw()
+        if base_index < 0:
+            return BASE_BYTES[draw % len(BASE_BYTES)]
+        return BASE_BYTES[(base_index + 1 + draw % (len(BASE_BYTES) - 1)) % len(BASE_BYTES)]
+
+    # uniform index below count
+    def index(self, count: int) -> int:
+        if DRAW_RANGE % count == 0:
+            return self._draw() % count
+        return int(self._generator.integers(0, count))
+
+    def choice(self, selection: str) -> str:
+        return selection[self.index(len(selection))]
+
+    # cheap position to return to (blocks are immutable bytes)
+    def snapshot(self):
+        return self._block, self._position, self._generator.bit_generator.state
+
+    def restore(self, snapshot):
+        self._block, self._position, self._generator.bit_generator.state = snapshot
+
+    # json friendly state for checkpoints
+    def get_state(self) -> Dict[str, Any]:
+        return {'generator': self._generator.bit_generator.state, 'block': list(self._block),
+                'position': self._position}
+
+    def set_state(self, state: Dict[str, Any]):
+        self._generator.bit_generator.state = state['generator']
+        self._block = bytes(state['block'])
+        self._position = state['position']
+
+
+# Every single point mutant of sequence in order (position, then IUPAC_RNA_BASE), built on one buffer
+def point_mutants(sequence: str):
+    buffer = bytearray(sequence, 'ascii')
+    for index, base in enumerate(buffer):
+        for new_base in BASE_BYTES:
+            if new_base != base:
+                buffer[index] = new_base
+                yield buffer.decode('ascii')
+        buffer[index] = base
+
+
+DEF_MAX_SIZE = 5
+MIN_MOVE_FACTOR = 0.25
+MAX_MOVE_FACTOR = 4.0
+MOVE_DECAY = 0.995
+
+
+# Adaptive (action, size) move distribution (opt in, options['moves']). Each bucket starts at the fixed distribution
+# (uniform action, triangular size) and is reweighted by its rate of accepted improvements compared to all moves,
+# bounded to [MIN_MOVE_FACTOR, MAX_MOVE_FACTOR] of its starting weight. Outcomes are recorded as moves are scored and
+# applied by commit() (once per iteration) so concurrent look ahead draws the same moves as the serial loop.
+class AdaptiveMoves:
+    def __init__(self, max_size: int = DEF_MAX_SIZE):
+        self.prior = {(action, size): max_size - size + 1 for action in Action for size in range(1, max_size)}
+        self.tries = {bucket: 0.0 for bucket in self.prior}
+        self.accepted = {bucket: 0.0 for bucket in self.prior}
+        self.improved = {bucket: 0.0 for bucket in self.prior}
+        self.weights = dict(self.prior)
+        self.last_bucket = None
+        self._pending = []
+
+    def __str__(self):
+        distribution = self.distribution()
+        return ', '.join(['{}:{} {:.3f} ({:.0f}/{:.0f}/{:.0f})'.format(action.name, size, distribution[(action, size)],
+                                                                       self.tries[(action, size)],
+                                                                       self.accepted[(action, size)],
+                                                                       self.improved[(action, size)])
+                          for action, size in self.prior])
+
+    # chooses (action, size) among the buckets of the allowed actions
+    def choose(self, actions: List[Action], rng=random):
+        buckets = [bucket for bucket in self.prior if bucket[0] in actions]
+        self.last_bucket = rng.choices(buckets, weights=[self.weights[bucket] for bucket in buckets])[0]
+        return self.last_bucket
+
+    def record(self, bucket, accepted: bool, improved: bool):
+        if bucket is not None:
+            self._pending.append((bucket, accepted, improved))
+
+    def commit(self):
+        if not self._pending:
+            return
+        for bucket in self.prior:
+            self.tries[bucket] *= MOVE_DECAY
+            self.accepted[bucket] *= MOVE_DECAY
+            self.improved[bucket] *= MOVE_DECAY
+        for bucket, accepted, improved in self._pending:
+            self.tries[bucket] += 1
+            self.accepted[bucket] += accepted
+            self.improved[bucket] += improved
+        self._pending = []
+        overall_rate = (sum(self.improved.values()) + 1) / (sum(self.tries.values()) + 2)
+        for bucket, prior in self.prior.items():
+            rate = (self.improved[bucket] + 1) / (self.tries[bucket] + 2)
+            self.weights[bucket] = prior * min(max(rate / overall_rate, MIN_MOVE_FACTOR), MAX_MOVE_FACTOR)
+
+    # proposal probability of each bucket when all actions are allowed
+    def distribution(self):
+        total = sum(self.weights.values())
+        return {bucket: weight / total for bucket, weight in self.weights.items()}
+
+    # json friendly state for checkpoints (pending outcomes are committed at the end of each iteration)
+    def get_state(self):
+        return {'{}:{}'.format(action.name, size): [self.tries[(action, size)], self.accepted[(action, size)],
+                                                   self.improved[(action, size)], self.weights[(action, size)]]
+                for action, size in self.prior}
+
+    def set_state(self, state):
+        for key, (tries, accepted, improved, weight) in state.items():
+            action, size = key.split(':')
+            bucket = (Action[action], int(size))
+            self.tries[bucket], self.accepted[bucket], self.improved[bucket] = tries, accepted, improved
+            self.weights[bucket] = weight
+
+
+# Outcome of the last proposed move for options['moves'] (if adaptive moves are on)
+def record_move(options: Dict[str, Any], bucket, accepted: bool, improved: bool):
+    moves = options.get('moves')
+    if moves is not None:
+        moves.record(bucket, accepted, improved)
+
+
+def last_move(options: Dict[str, Any]):
+    moves = options.get('moves')
+    return moves.last_bucket if moves is not None else None
+
+
+# Mutation index weights of the current match tree (see shapiro_tree_aligner.get_mismatch_weights), None if the tree
+# matches perfectly. The last match tree and its weights are kept in options['mismatch_weights'].
+def get_index_weights(current_sequence: str, match_tree: tree_aligner.Tree, options: Dict[str, Any]) -> List[int]:
+    cached = options.get('mismatch_weights')
+    if cached is not None and cached[0] is match_tree and cached[1] == current_sequence:
+        return cached[2]
+    weights = shapiro_tree_aligner.get_mismatch_weights(match_tree, len(current_sequence))
+    if not any(weights):
+        weights = None
+    options['mismatch_weights'] = (match_tree, current_sequence, weights)
+    return weights
+
+
+# With probability options['targeted'] the mutation index is drawn by the mismatch weights of match_tree, otherwise
+# uniformly (keeps every position reachable)
 def perturbate(current_sequence: str, match_tree: tree_aligner.Tree, options: Dict[str, Any]) -> str:
     min_length = len(options.get('target_structure')) - options.get('vlength')
     max_length = len(options.get('target_structure')) + options.get('vlength')
+    sequence_constraints = options.get('constraints')
+    if sequence_constraints is not None and sequence_constraints.applies_to(current_sequence):
+        return constrained_mutation(current_sequence, sequence_constraints, match_tree, options)
+    moves = options.get('moves')
+    rng = get_random(options)
     actions = [Action.REPLACE]
     if len(current_sequence) < max_length:
         actions.append(Action.ADD)
     if len(current_sequence) > min_length:
         actions.append(Action.REMOVE)
+    index_weights = None
+    targeted = options.get('targeted', DEF_TARGETED)
+    if targeted > 0 and match_tree is not None and rng.random() < targeted:
+        index_weights = get_index_weights(current_sequence, match_tree, options)
+    if moves is not None:
+        action, size = moves.choose(actions, rng)
+    else:
+        action, size = rng.choice(actions), None
     # mutated_sequence = simple_point_mutation(current_sequence, random.choice(actions))
-    mutated_sequence = multi_point_mutation(current_sequence, min_length, max_length, random.choice(actions))
+    mutated_sequence = multi_point_mutation(current_sequence, min_length, max_length, action,
+                                            index_weights=index_weights, size=size,
+                                            base_draws=options.get('base_draws'), rng=rng)
     return mutated_sequence
 
 
-def simple_point_mutation(old_sequence: str, action: Action=Action.REPLACE) -> str:
-    index = random.randint(0, len(old_sequence) - 1)
+def simple_point_mutation(old_sequence: str, action: Action=Action.REPLACE, rng=random) -> str:
+    index = rng.randint(0, len(old_sequence) - 1)
     if action == Action.REPLACE:
-        sequence = old_sequence[:index] + random.choice(IUPAC.IUPAC_RNA_BASE.replace(old_sequence[index], '')) + \
+        sequence = old_sequence[:index] + rng.choice(IUPAC.IUPAC_RNA_BASE.replace(old_sequence[index], '')) + \
                    old_sequence[index + 1:]
     elif action == Action.ADD:
-        sequence = old_sequence[:index] + random.choice(IUPAC.IUPAC_RNA_BASE.replace(old_sequence[index], '')) + \
+        sequence = old_sequence[:index] + rng.choice(IUPAC.IUPAC_RNA_BASE.replace(old_sequence[index], '')) + \
                    old_sequence[index:]
     elif action == Action.REMOVE:
         sequence = old_sequence[:index] + old_sequence[index + 1:]
@@ -48,33 +261,103 @@ def simple_point_mutation(old_sequence: str, action: Action=Action.REPLACE) -> s
 
 
 def multi_point_mutation(old_sequence: str, min_length:int, max_length: int, action: Action=Action.REPLACE,
-                         max_size: int=5) -> str:
+                         max_size: int=DEF_MAX_SIZE, index_weights: List[int]=None, size: int=None,
+                         base_draws: BaseDraws=None, rng=random) -> str:
     def gen_sequence(gen_size: int, old_seq: str= None) -> str:
         res = ''
         # if we replace, select an index to be different for sure
         rand_loc = None
         if old_seq is not None:
-            rand_loc = random.randint(0, len(old_seq) - 1)
+            rand_loc = rng.randint(0, len(old_seq) - 1)
         # generate new subseq
         for i in range(0, gen_size):
             selection = IUPAC.IUPAC_RNA_BASE
             if i == rand_loc:
                 selection = selection.replace(old_seq[rand_loc], '')
-            res += random.choice(selection)
+            res += rng.choice(selection)
         return res
-    index = random.randint(0, len(old_sequence) - 1)
+    if index_weights is None:
+        index = rng.randint(0, len(old_sequence) - 1)
+    else:
+        index = rng.choices(range(0, len(old_sequence)), weights=index_weights)[0]
     dist = []
     for i in range(1, max_size):
         dist += [i] * (max_size - i + 1)
+    if size is None:
+        size = rng.choice(dist)
+    if base_draws is not None:
+        return _buffer_mutation(old_sequence, min_length, max_length, action, index, size, base_draws)
     if action == Action.REPLACE:
-        size = min(random.choice(dist), len(old_sequence) - index)
+        size = min(size, len(old_sequence) - index)
         new_part = gen_sequence(size, old_sequence[index : index + size])
         sequence = old_sequence[:index] + new_part + old_sequence[index + size:]
     elif action == Action.ADD:
-        size = min(random.choice(dist), max_length - len(old_sequence))
+        size = min(size, max_length - len(old_sequence))
         new_part = gen_sequence(size)
         sequence = old_sequence[:index] + new_part + old_sequence[index:]
     elif action == Action.REMOVE:
-        size = min(random.choice(dist), len(old_sequence) - index, max(1, len(old_sequence) - min_length))
+        size = min(size, len(old_sequence) - index, max(1, len(old_sequence) - min_length))
         sequence = old_sequence[:index] + old_sequence[index + size:]
     return sequence
+
+
+# multi_point_mutation on an ascii buffer with the bases drawn from base_draws
+def _buffer_mutation(old_sequence: str, min_length: int, max_length: int, action: Action, index: int, size: int,
+                     base_draws: BaseDraws) -> str:
+    buffer = bytearray(old_sequence, 'ascii')
+    if action == Action.REPLACE:
+        size = min(size, len(buffer) - index)
+        new_part = bytearray(base_draws.bases(size))
+        # one base is different for sure
+        rand_loc = base_draws.index(size)
+        new_part[rand_loc] = base_draws.other_base(buffer[index + rand_loc])
+        buffer[index:index + size] = new_part
+    elif action == Action.ADD:
+        size = min(size, max_length - len(buffer))
+        buffer[index:index] = base_draws.bases(size)
+    elif action == Action.REMOVE:
+        size = min(size, len(buffer) - index, max(1, len(buffer) - min_length))
+        del buffer[index:index + size]
+    return buffer.decode('ascii')
+
+
+# Replace mutation within the compiled constraints (constraints.SequenceConstraints): starts at a mutable position
+# (changing its base), draws every base from the allowed bases and keeps protected positions. Additions and removals
+# would shift the positions of the constraints and are not proposed.
+def constrained_mutation(old_sequence: str, sequence_constraints: constraints.SequenceConstraints,
+                         match_tree: tree_aligner.Tree, options: Dict[str, Any], max_size: int=DEF_MAX_SIZE) -> str:
+    mutable = sequence_constraints.mutable_indexes(old_sequence)
+    if not mutable:
+        return old_sequence
+    rng = get_random(options)
+    index_weights = None
+    targeted = options.get('targeted', DEF_TARGETED)
+    if targeted > 0 and match_tree is not None and rng.random() < targeted:
+        index_weights = get_index_weights(old_sequence, match_tree, options)
+    if index_weights is not None:
+        index_weights = [index_weights[index] for index in mutable]
+        if not any(index_weights):
+            index_weights = None
+    if index_weights is None:
+        index = rng.choice(mutable)
+    else:
+        index = rng.choices(mutable, weights=index_weights)[0]
+    if options.get('moves') is not None:
+        size = options['moves'].choose([Action.REPLACE], rng)[1]
+    else:
+        dist = []
+        for i in range(1, max_size):
+            dist += [i] * (max_size - i + 1)
+        size = rng.choice(dist)
+    size = min(size, len(old_sequence) - index)
+    choice = rng.choice if options.get('base_draws') is None else options['base_draws'].choice
+    buffer = bytearray(old_sequence, 'ascii')
+    for position in range(index, index + size):
+        allowed = sequence_constraints.allowed[position]
+        if sequence_constraints.is_protected[position]:
+            continue
+        elif position == index:
+            buffer[position] = ord(choice(allowed.replace(old_sequence[position], '') or allowed))
+        else:
+            buffer[position] = ord(choice(allowed))
+    return buffer.decode('ascii')
@@ -0,0 +1,240 @@
+'''
+Concurrent scoring of candidate sequences and concurrent independent designs.
+Folding runs on several live RNAfold workers (threads wait on the RNAfold processes) and tree alignments / design
+chains run on process pools.
+'''
+
+import os
+import queue
+import random
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from rnafbinv import vienna, shapiro_tree_aligner, tree_aligner, sfb_designer, session
+
+
+# A set of live RNAfold processes, each fold call takes an idle one
+class FoldPool:
+    def __init__(self, workers: int, is_circular: bool = False, logger=None):
+        self.workers = workers
+        self._folders = [vienna.LiveRNAfold(logger) for _ in range(workers)]
+        self._idle = queue.Queue()
+        for folder in self._folders:
+            folder.start(is_circular)
+            self._idle.put(folder)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def fold(self, sequence: str) -> Dict[str, str]:
+        folder = self._idle.get()
+        try:
+            return folder.fold(sequence)
+        finally:
+            self._idle.put(folder)
+
+    # folds in parallel, results are in the order of the sequences
+    def fold_many(self, sequences: List[str]) -> List[Dict[str, str]]:
+        return list(self._executor.map(self.fold, sequences))
+
+    def submit(self, func, *args):
+        return self._executor.submit(func, *args)
+
+    def close(self):
+        self._executor.shutdown()
+        for folder in self._folders:
+            folder.close()
+        self._folders = []
+
+
+# Target of the alignment worker processes, installed once per pool by _init_align_worker
+_WORKER_TARGET_TREE = None
+_WORKER_ALIGNMENT_RULES = None
+
+
+def _init_align_worker(target_tree: tree_aligner.Tree, alignment_rules: tree_aligner.AlignmentRules):
+    global _WORKER_TARGET_TREE, _WORKER_ALIGNMENT_RULES
+    _WORKER_TARGET_TREE = target_tree
+    _WORKER_ALIGNMENT_RULES = alignment_rules
+
+
+def _align_folded(structure: str, sequence: str):
+    return shapiro_tree_aligner.align_trees(shapiro_tree_aligner.get_tree(structure, sequence), _WORKER_TARGET_TREE,
+                                            _WORKER_ALIGNMENT_RULES)
+
+
+# Folds candidates on a FoldPool and aligns each one on a process pool as soon as its fold is ready.
+# Created and closed by the caller (same as options['RNAfold']), workers <= 1 is not parallel.
+# The target tree and alignment rules are sent to the alignment workers once, when the pool is started for them
+# (again if a later call scores against another target), tasks only send the folded candidate.
+class CandidateScorer:
+    def __init__(self, workers: int, is_circular: bool = False, logger=None):
+        self.workers = workers
+        self.fold_pool = FoldPool(workers, is_circular, logger)
+        self._align_pool = None
+        self._align_target = None
+        self._align_lock = threading.Lock()
+
+    def _get_align_pool(self, target_tree, alignment_rules) -> ProcessPoolExecutor:
+        with self._align_lock:
+            if self._align_target is None or self._align_target[0] is not target_tree or \
+                    self._align_target[1] is not alignment_rules:
+                if self._align_pool is not None:
+                    self._align_pool.shutdown()
+                # spawn: the parent holds RNAfold reader threads
+                self._align_pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                       mp_context=multiprocessing.get_context('spawn'),
+                                                       initializer=_init_align_worker,
+                                                       initargs=(target_tree, alignment_rules))
+                self._align_target = (target_tree, alignment_rules)
+            return self._align_pool
+
+    def _fold_and_align(self, sequence, fold_type, align_pool):
+        fold_map = self.fold_pool.fold(sequence)
+        tree, score = align_pool.submit(_align_folded, fold_map[fold_type], sequence).result()
+        return fold_map, tree, score
+
+    # returns (fold map, aligned tree, alignment score) per sequence, in the order of the sequences
+    def score_many(self, sequences: List[str], fold_type: str, target_tree: tree_aligner.Tree,
+                   alignment_rules: tree_aligner.AlignmentRules) -> List[Tuple[Dict[str, str], tree_aligner.Tree,
+                                                                               float]]:
+        align_pool = self._get_align_pool(target_tree, alignment_rules)
+        futures = [self.fold_pool.submit(self._fold_and_align, sequence, fold_type, align_pool)
+                   for sequence in sequences]
+        return [future.result() for future in futures]
+
+    def close(self):
+        with self._align_lock:
+            if self._align_pool is not None:
+                self._align_pool.shutdown()
+            self._align_pool = None
+            self._align_target = None
+        self.fold_pool.close()
+
+
+# Options that belong to the calling process and are not sent to design workers
+PROCESS_LOCAL_OPTIONS = sfb_designer.PROCESS_LOCAL_OPTIONS
+LOG_FORMAT = '%(levelname)s:%(asctime)s - %(message)s'
+
+
+# Seeds of multi start designs, the first design uses the base seed and the others are drawn from it
+def derive_seeds(base_seed: int, count: int) -> List[int]:
+    seed_generator = random.Random(base_seed)
+    return [base_seed] + [seed_generator.getrandbits(32) for _ in range(1, count)]
+
+
+# Checkpoint file of one of several designs (options['checkpoint'] / options['resume'] name the design set)
+def design_checkpoint_path(path: str, design_index: int) -> str:
+    return "{}.{}".format(path, design_index)
+
+
+# Options of a single design, each design writes / resumes its own checkpoint file
+def _single_design_options(design_options: Dict[str, Any], design_index: int) -> Dict[str, Any]:
+    single_options = dict(design_options)
+    for key in ('checkpoint', 'resume'):
+        if single_options.get(key) is not None:
+            single_options[key] = design_checkpoint_path(single_options[key], design_index)
+    return single_options
+
+
+# options['updater'] of a design worker, reports progress to the caller and passes on a stop request
+class _DesignUpdater:
+    def __init__(self, design_index: int, options: Dict[str, Any], progress_queue, stop_event):
+        self.design_index = design_index
+        self.options = options
+        self.progress_queue = progress_queue
+        self.stop_event = stop_event
+
+    def update(self, iteration: int):
+        if self.progress_queue is not None:
+            self.progress_queue.put((self.design_index, iteration))
+        if self.stop_event.is_set():
+            self.options['stop'] = True
+
+
+def _run_design(design_index: int, seed: int, options: Dict[str, Any], log_name: str, log_level: int,
+                progress_queue, stop_event):
+    logger = logging.getLogger(log_name)
+    logger.setLevel(log_level)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        logger.addHandler(handler)
+    options['logger'] = logger
+    with session.DesignSession(options, seed) as design_session:
+        design_session.options['updater'] = _DesignUpdater(design_index, design_session.options, progress_queue,
+                                                           stop_event)
+        designed_sequence = design_session.run()
+        if designed_sequence is None or design_session.is_stopped():
+            return design_index, seed, None
+        logger.info("Design {} (seed {}) resulting sequence: {}".format(design_index + 1, seed, designed_sequence))
+        return design_index, seed, design_session.result(designed_sequence)
+
+
+# Runs num_designs independent design chains (options['engine']) on a process pool, each with its own RNAfold and a
+# seed derived from options['rng'] (random if missing). Yields (design index, seed, RnafbinvResult or None if failed /
+# stopped) in completion order. progress(design index, iteration) is called from the iterating thread,
+# options['stop'] (see sfb_designer.stop) or closing the generator stops the running designs.
+# With options['checkpoint'] / options['resume'] design i writes / resumes its own file <path>.i.
+def design_many(options: Dict[str, Any], num_designs: int, processes: int = None,
+                progress: Callable[[int, int], Any] = None) -> Iterator[Tuple[int, int, Any]]:
+    base_seed = options.get('rng')
+    if base_seed is None:
+        base_seed = random.SystemRandom().getrandbits(32)
+    logger = options.get('logger')
+    if isinstance(logger, logging.Logger):
+        log_name, log_level = logger.name, logger.getEffectiveLevel()
+    else:
+        log_name, log_level = 'RNAsfbinv', logging.getLogger().getEffectiveLevel()
+    logging.getLogger(log_name).info("Running {} designs, base seed {}".format(num_designs, base_seed))
+    design_options = {key: value for key, value in options.items() if key not in PROCESS_LOCAL_OPTIONS}
+    # the target is prepared once and sent to the workers with the options
+    sfb_designer.get_design_context(design_options)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, num_designs))
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        progress_queue = manager.Queue() if progress is not None else None
+        stop_event = manager.Event()
+        executor = ProcessPoolExecutor(max_workers=processes, mp_context=context)
+        try:
+            pending = {executor.submit(_run_design, design_index, seed,
+                                       _single_design_options(design_options, design_index), log_name, log_level,
+                                       progress_queue, stop_event)
+                       for design_index, seed in enumerate(derive_seeds(base_seed, num_designs))}
+            while pending:
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                if options.get('stop') is not None:
+                    stop_event.set()
+                while progress_queue is not None:
+                    try:
+                        progress(*progress_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for future in done:
+                    yield future.result()
+        finally:
+            stop_event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    import tempfile
+    logging.basicConfig(level=logging.WARNING)
+    # TEST multi design resume: each design resumes its own checkpoint and the designs stay distinct
+    test_options = {'logger': logging.getLogger('RNAsfbinv'), 'fold': 'MFE', 'look_ahead': 4, 'circular': False,
+                    'motifs': [], 'random': True, 'vlength': 0, 'seq_motif': False, 'reduced_bi': 0, 'rng': 3,
+                    'target_structure': '((((((((...(.(((((.......))))).)........((((((.......))))))..))))))))',
+                    'target_sequence': 'NNNNNNNNUNNNNNNNNNNNNNNNNNNNNNNNNUNNNUNNNNNNNNNNNNNNNNNNNNNNYNNNNNNNN',
+                    'checkpoint_interval': 5}
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        checkpoint_path = os.path.join(checkpoint_dir, 'designs.json')
+        first_options = dict(test_options, iter=10, checkpoint=checkpoint_path)
+        first = {index: result.sequence for index, _, result in design_many(first_options, 3)}
+        resumed_options = dict(test_options, iter=20, checkpoint=checkpoint_path, resume=checkpoint_path)
+        resumed = {index: result.sequence for index, _, result in design_many(resumed_options, 3)}
+        print("Checkpoint files: {}".format(sorted(os.listdir(checkpoint_dir))))
+        print("Designs: {}\nResumed designs: {}".format(first, resumed))
+        print("Resumed designs are distinct: {}".format(len(set(resumed.values())) == len(resumed)))
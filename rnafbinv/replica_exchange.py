@@ -0,0 +1,169 @@
+'''
+Replica exchange (parallel tempering) design engine.
+K replicas run the annealing moves (mutator.perturbate + sfb_designer.score_sequence) at fixed temperatures of a
+ladder, each epoch on a process pool with its own RNAfold. Between epochs adjacent replicas try to swap sequences.
+'''
+
+import math
+import atexit
+import random
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List
+
+from rnafbinv import sfb_designer, mutator, vienna, tree_aligner, budget
+
+DEF_REPLICAS = 4
+DEF_SWAP_INTERVAL = 10
+
+# live RNAfold, visited sequence memo, target tree and design options of a replica worker process (shared by the
+# replicas it runs, sent once when the worker starts)
+_WORKER_FOLDER = None
+_WORKER_SCORE_MEMO = None
+_WORKER_TARGET_TREE = None
+_WORKER_OPTIONS = None
+
+
+# Replica configuration and its own random state (the random state stays with the ladder slot on swaps)
+class ReplicaState:
+    def __init__(self, sequence: str, tree: tree_aligner.Tree, score: float, random_state,
+                 base_draws: mutator.BaseDraws = None):
+        self.sequence = sequence
+        self.tree = tree
+        self.score = score
+        self.random_state = random_state
+        self.base_draws = base_draws
+        self.best_sequence = sequence
+        self.best_score = score
+        self.accepted = 0
+        self.folds = 0
+
+
+# Geometric ladder from the final annealing temperature (coldest) to the initial one (hottest)
+def temperature_ladder(replicas: int, iterations: int) -> List[float]:
+    cold = sfb_designer.calc_temp(max(iterations - 1, 0), iterations)
+    hot = sfb_designer.INITIAL_TEMP
+    if replicas <= 1:
+        return [cold]
+    return [cold * math.pow(hot / cold, index / (replicas - 1)) for index in range(0, replicas)]
+
+
+def _init_worker(is_circular: bool, score_memo_size: int, target_tree: tree_aligner.Tree, options: Dict[str, Any]):
+    global _WORKER_FOLDER, _WORKER_SCORE_MEMO, _WORKER_TARGET_TREE, _WORKER_OPTIONS
+    _WORKER_FOLDER = vienna.LiveRNAfold()
+    _WORKER_FOLDER.start(is_circular)
+    atexit.register(_WORKER_FOLDER.close)
+    _WORKER_SCORE_MEMO = sfb_designer.start_score_memo({'score_memo_size': score_memo_size})
+    _WORKER_TARGET_TREE = target_tree
+    _WORKER_OPTIONS = options
+
+
+# Runs steps annealing moves at a fixed temperature, returns the updated state
+def _run_epoch(state: ReplicaState, temperature: float, steps: int) -> ReplicaState:
+    target_tree = _WORKER_TARGET_TREE
+    options = dict(_WORKER_OPTIONS)
+    options['RNAfold'] = _WORKER_FOLDER
+    options['score_memo'] = _WORKER_SCORE_MEMO
+    options['base_draws'] = state.base_draws
+    # counts the folds of this epoch (memo hits are not folded)
+    options['budget'] = budget.DesignBudget()
+    rng = random.Random()
+    rng.setstate(state.random_state)
+    options['random_generator'] = rng
+    for step in range(0, steps):
+        new_sequence = mutator.perturbate(state.sequence, state.tree, options)
+        new_tree, new_score = sfb_designer.score_sequence(new_sequence, target_tree, options)
+        probability = sfb_designer.acceptance_probability(state.score, new_score, temperature, len(state.sequence))
+        if rng.random() < probability:
+            state.sequence, state.tree, state.score = new_sequence, new_tree, new_score
+            state.accepted += 1
+        if state.score < state.best_score:
+            state.best_sequence, state.best_score = state.sequence, state.score
+        if state.best_score == 0:
+            break
+    state.random_state = rng.getstate()
+    state.folds += options['budget'].folds
+    return state
+
+
+# Adjacent pairs (even pairs on even epochs, odd pairs on odd epochs) swap configurations with probability
+# min(1, exp((1/kT_i - 1/kT_j) * (score_i - score_j))), k is the sequence length as in acceptance_probability
+def _attempt_swaps(states: List[ReplicaState], temperatures: List[float], epoch: int, rng=random) -> int:
+    swaps = 0
+    for index in range(epoch % 2, len(states) - 1, 2):
+        cold, hot = states[index], states[index + 1]
+        delta = (1.0 / (len(cold.sequence) * temperatures[index]) -
+                 1.0 / (len(hot.sequence) * temperatures[index + 1])) * (cold.score - hot.score)
+        if delta >= 0 or rng.random() < math.exp(delta):
+            cold.sequence, hot.sequence = hot.sequence, cold.sequence
+            cold.tree, hot.tree = hot.tree, cold.tree
+            cold.score, hot.score = hot.score, cold.score
+            swaps += 1
+    return swaps
+
+
+# Same input / output as sfb_designer.simulated_annealing: options['iter'] moves per replica, options['replicas']
+# replicas and a swap attempt every options['swap_interval'] moves.
+def replica_exchange(options: Dict[str, Any]):
+    if len(options) == 0:
+        options.get('logger').fatal("Options object was not properly initiated. ")
+        return None
+    design_start = sfb_designer.initialize_design(options)
+    if design_start is None:
+        return None
+    current_sequence, target_tree = design_start
+    design_budget = budget.get_budget(options)
+    no_iterations = options.get('iter')
+    no_replicas = max(1, options.get('replicas', DEF_REPLICAS))
+    swap_interval = max(1, options.get('swap_interval', DEF_SWAP_INTERVAL))
+    temperatures = temperature_ladder(no_replicas, no_iterations)
+    rng = mutator.get_random(options)
+    match_tree, current_score = sfb_designer.score_sequence(current_sequence, target_tree, options)
+    options.get('logger').info('Initial sequence ({}): {}\nTemperatures: {}'.format(current_score, current_sequence,
+                                                                                    temperatures))
+    # every replica starts from the initial sequence with a random state (and base draws) seeded from the (seeded)
+    # global one
+    states = [ReplicaState(current_sequence, match_tree, current_score,
+                           random.Random(rng.getrandbits(32)).getstate()) for _ in range(0, no_replicas)]
+    if options.get('base_draws') is not None:
+        for state in states:
+            state.base_draws = mutator.BaseDraws(rng.getrandbits(64))
+    final_result, best_score = current_sequence, current_score
+    worker_options = {key: value for key, value in options.items() if key not in sfb_designer.PROCESS_LOCAL_OPTIONS}
+    updater = options.get('updater')
+    swaps = 0
+    done_iterations = 0
+    worker_args = (options.get('circular', False), options.get('score_memo_size', sfb_designer.DEF_SCORE_MEMO_SIZE),
+                   target_tree, worker_options)
+    with ProcessPoolExecutor(max_workers=no_replicas, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=worker_args) as executor:
+        epoch = 0
+        while done_iterations < no_iterations and best_score != 0:
+            if options.get('stop') is not None:
+                return None
+            if design_budget.expired():
+                options.get('logger').info('Budget expired at iteration {}: {}'.format(done_iterations,
+                                                                                      design_budget))
+                break
+            steps = min(swap_interval, no_iterations - done_iterations)
+            remaining_folds = design_budget.remaining_folds()
+            if remaining_folds is not None:
+                steps = max(1, min(steps, remaining_folds // no_replicas))
+            folds_before = sum([state.folds for state in states])
+            futures = [executor.submit(_run_epoch, state, temperature, steps)
+                       for state, temperature in zip(states, temperatures)]
+            states = [future.result() for future in futures]
+            design_budget.add_folds(sum([state.folds for state in states]) - folds_before)
+            done_iterations += steps
+            for state in states:
+                if state.best_score < best_score:
+                    final_result, best_score = state.best_sequence, state.best_score
+            swaps += _attempt_swaps(states, temperatures, epoch, rng)
+            epoch += 1
+            options.get('logger').debug('Iteration {} replica scores: {} best ({}): {}'.format(
+                done_iterations, [state.score for state in states], best_score, final_result))
+            if updater is not None:
+                updater.update(done_iterations)
+    options.get('logger').info('Replica exchange: {} swaps in {} epochs, accepted moves per replica: {}, budget '
+                               'spent: {}'.format(swaps, epoch, [state.accepted for state in states], design_budget))
+    return final_result
@@ -0,0 +1,132 @@
+'''
+Immutable dot bracket structure with its pair table, helix list and loop decomposition.
+Structures are interned through get_structure so each structure string is parsed once and shared by all modules.
+'''
+
+import numpy as np
+from rnafbinv import memo
+
+
+class Structure(object):
+    # Raises ValueError if the dot bracket holds anything but '(', ')' and '.' or is not balanced.
+    # pair_table[i] is the index paired with i or -1 (read only numpy array).
+    # helices are (start, end, length) of maximal stacked pairs, outer pair (start, end), ordered by start.
+    # helix_loops[h] is the loop closed by the inner pair of helix h and exterior_loop the external loop,
+    # each loop is (unpaired indexes, helix indexes of the enclosed helices), both ordered 5' to 3'.
+    def __init__(self, dot_bracket: str):
+        if not set(dot_bracket) <= {'(', ')', '.'}:
+            raise ValueError("Dot bracket can hold '(', ')' and '.' only: {}".format(dot_bracket))
+        self.dot_bracket = dot_bracket
+        self.pair_table = _make_pair_table(dot_bracket)
+        self.pair_table.flags.writeable = False
+        self.helices = _make_helices(self.pair_table)
+        self.exterior_loop, self.helix_loops = _make_loops(dot_bracket, self.helices)
+
+    def __len__(self):
+        return len(self.dot_bracket)
+
+    def __str__(self):
+        return self.dot_bracket
+
+    def __eq__(self, other):
+        return isinstance(other, Structure) and self.dot_bracket == other.dot_bracket
+
+    def __hash__(self):
+        return hash(self.dot_bracket)
+
+    # all base pairs (i, j) with i < j ordered by i
+    def pairs(self):
+        opening = np.nonzero(self.pair_table > np.arange(len(self.pair_table)))[0]
+        return list(zip(opening.tolist(), self.pair_table[opening].tolist()))
+
+    # Number of base pairs in only one of the structures (positions beyond the shorter structure are ignored)
+    def bp_distance(self, other: 'Structure') -> int:
+        length = min(len(self), len(other))
+        table_a = self.pair_table[:length]
+        table_b = other.pair_table[:length]
+        positions = np.arange(length)
+        differ = table_a != table_b
+        return int(np.count_nonzero(differ & (table_a > positions)) + np.count_nonzero(differ & (table_b > positions)))
+
+
+# Brackets are matched by nesting depth: at each depth openings and closings alternate along the structure
+def _make_pair_table(dot_bracket: str) -> np.ndarray:
+    pair_table = np.full(len(dot_bracket), -1, dtype=np.int64)
+    if not dot_bracket:
+        return pair_table
+    chars = np.frombuffer(dot_bracket.encode('ascii'), dtype=np.uint8)
+    steps = (chars == ord('(')).astype(np.int64) - (chars == ord(')'))
+    depth = np.cumsum(steps)
+    if depth.min() < 0 or depth[-1] != 0:
+        raise ValueError("Dot bracket is not balanced: {}".format(dot_bracket))
+    brackets = np.nonzero(steps)[0]
+    # an opening gets its depth after the step and a closing before the step
+    levels = depth[brackets] + (steps[brackets] < 0)
+    ordered = brackets[np.argsort(levels, kind='stable')]
+    opening = ordered[0::2]
+    closing = ordered[1::2]
+    pair_table[opening] = closing
+    pair_table[closing] = opening
+    return pair_table
+
+
+def _make_helices(pair_table: np.ndarray):
+    opening = np.nonzero(pair_table > np.arange(len(pair_table)))[0]
+    if len(opening) == 0:
+        return ()
+    partners = pair_table[opening]
+    # pair (i, j) continues the helix of the previous opening if it was (i - 1, j + 1)
+    stacked = np.zeros(len(opening), dtype=bool)
+    stacked[1:] = (opening[1:] == opening[:-1] + 1) & (partners[1:] == partners[:-1] - 1)
+    starts = np.nonzero(~stacked)[0]
+    lengths = np.diff(np.append(starts, len(opening)))
+    return tuple(zip(opening[starts].tolist(), partners[starts].tolist(), lengths.tolist()))
+
+
+def _make_loops(dot_bracket: str, helices):
+    outer_openings = {}
+    inner_openings = {}
+    inner_closings = set()
+    for helix_index, (start, end, length) in enumerate(helices):
+        outer_openings[start] = helix_index
+        inner_openings[start + length - 1] = helix_index
+        inner_closings.add(end - length + 1)
+    exterior_loop = ([], [])
+    helix_loops = [([], []) for _ in helices]
+    loop_stack = [exterior_loop]
+    for i, c in enumerate(dot_bracket):
+        if c == '.':
+            loop_stack[-1][0].append(i)
+        elif c == '(':
+            helix_index = outer_openings.get(i)
+            if helix_index is not None:
+                loop_stack[-1][1].append(helix_index)
+            helix_index = inner_openings.get(i)
+            if helix_index is not None:
+                loop_stack.append(helix_loops[helix_index])
+        elif i in inner_closings:
+            loop_stack.pop()
+    return (tuple(exterior_loop[0]), tuple(exterior_loop[1])), \
+        tuple((tuple(unpaired), tuple(children)) for unpaired, children in helix_loops)
+
+
+# Interned structures, a structure is parsed once while it stays in the cache
+STRUCTURE_CACHE = memo.LRUMemo(max_size=10000)
+
+
+def get_structure(dot_bracket) -> Structure:
+    if isinstance(dot_bracket, Structure):
+        return dot_bracket
+    result = STRUCTURE_CACHE.get(dot_bracket)
+    if result is None:
+        result = Structure(dot_bracket)
+        STRUCTURE_CACHE.put(dot_bracket, result)
+    return result
+
+
+def is_valid(dot_bracket: str) -> bool:
+    try:
+        get_structure(dot_bracket)
+    except ValueError:
+        return False
+    return True
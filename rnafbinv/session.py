@@ -0,0 +1,59 @@
+'''
+A single design run with its own options copy, random generator, RNAfold process and stop token.
+Sessions do not share run state, so several designs can run on threads of one process (the alignment and structure
+memos are shared and locked) and each reproduces its seed exactly (random.Random(seed) draws the same sequence as
+random.seed(seed)).
+The target is prepared once when the options already hold its design context (sfb_designer.get_design_context).
+'''
+
+import random
+from typing import Any, Dict
+
+from rnafbinv import vienna, sfb_designer, engines
+
+# Options written by a design run, a session starts without them
+RUN_STATE_OPTIONS = ('stop', 'budget', 'score_memo', 'moves', 'base_draws', 'alignment_rules', 'constraints',
+                     'mismatch_weights', 'elite', 'random_generator', 'session')
+
+
+class DesignSession:
+    # options is copied (the caller's map is not changed by the run), seed overrides options['rng'].
+    # Without a folder the session starts (and closes) its own RNAfold.
+    def __init__(self, options: Dict[str, Any], seed: int = None, folder: vienna.LiveRNAfold = None):
+        self.options = {key: value for key, value in options.items() if key not in RUN_STATE_OPTIONS}
+        if seed is not None:
+            self.options['rng'] = seed
+        self.random = random.Random(self.options.get('rng'))
+        self.options['random_generator'] = self.random
+        self.options['session'] = self
+        self._own_folder = None
+        if folder is None:
+            folder = vienna.LiveRNAfold(self.options.get('logger'))
+            folder.start(self.options.get('circular', False))
+            self._own_folder = folder
+        self.options['RNAfold'] = folder
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # stop token, the running engine returns None
+    def stop(self):
+        sfb_designer.stop(self.options)
+
+    def is_stopped(self) -> bool:
+        return self.options.get('stop') is not None
+
+    # runs options['engine'], returns the designed sequence (None on failure / stop)
+    def run(self):
+        return engines.run_engine(self.options)
+
+    def result(self, sequence: str) -> sfb_designer.RnafbinvResult:
+        return sfb_designer.generate_res_object(sequence, self.options)
+
+    def close(self):
+        if self._own_folder is not None:
+            self._own_folder.close()
+            self._own_folder = None
@@ -3,76 +3,155 @@
 Main loop for RNAsfbinv.
 '''
 
+import os
+import json
 import logging
 import random
 import math
+import tempfile
+from abc import ABC, abstractmethod
 
-from typing import Dict, Any
+from typing import Dict, Any, List
 
-from rnafbinv import shapiro_tree_aligner, vienna, tree_aligner, shapiro_generator, mutator, IUPAC
+from rnafbinv import shapiro_tree_aligner, vienna, tree_aligner, mutator, IUPAC, rna_structure, \
+    budget, memo, constraints, design_context, elite
+
+
+# Options that belong to the calling process (RNAfold, run state, callbacks) and are not sent to worker processes
+PROCESS_LOCAL_OPTIONS = ('logger', 'RNAfold', 'scorer', 'updater', 'stop', 'budget', 'score_memo',
+                         'random_generator', 'session')
 
 
 def stop(options: Dict[str, Any]):
     options['stop'] = True
 
 
-def generate_random_start(length: int, target_sequence: str) -> str:
+# Resolves the wildcards of target_sequence with random bases, sequence_constraints (if given and of the same length)
+# restricts each position to its allowed bases. Bases come from base_draws if given (see mutator.BaseDraws).
+def generate_random_start(length: int, target_sequence: str,
+                          sequence_constraints: constraints.SequenceConstraints = None,
+                          base_draws: mutator.BaseDraws = None, rng=random) -> str:
     temp = target_sequence.upper()
-    res = ''
+    choice = rng.choice if base_draws is None else base_draws.choice
+    res = bytearray(length)
     for i in range(0, length):
-        res += random.choice(IUPAC.IUPAC_XNA_MAP.get(temp[i]).replace('T', ''))
-    return res
+        bases = IUPAC.IUPAC_XNA_MAP.get(temp[i]).replace('T', '')
+        if sequence_constraints is not None and sequence_constraints.applies_to(temp):
+            bases = ''.join([c for c in bases if c in sequence_constraints.allowed[i]]) or \
+                sequence_constraints.allowed[i]
+        res[i] = ord(choice(bases))
+    return res.decode('ascii')
 
 
 def bp_distance(structure_a, structure_b):
-    def make_pair_table(structure):
-        result = [0] * len(structure)
-        brackets = []
-        index = 0
-        for c in structure:
-            if c == '(':
-                brackets.append(index)
-            elif c == ')':
-                if len(brackets) == 0:
-                    raise Exception('Error calculating bp distance: unbalanced brackets')
-                base_index = brackets.pop()
-                result[index] = index
-                result[base_index] = index
-            index += 1
-        return result
-
-    table_a = make_pair_table(structure_a)
-    table_b = make_pair_table(structure_b)
-    dist = 0
-    for i in range(0, min(len(table_a), len(table_b))):
-        if table_a[i] != table_b[i]:
-            if table_a[i] > i:
-                dist += 1
-            if table_b[i] > i:
-                dist += 1
-    return dist
+    return rna_structure.get_structure(structure_a).bp_distance(rna_structure.get_structure(structure_b))
 
 
 def calculate_neutrality(sequence: str, target_structure: str, options: Dict[str, Any]):
+    if options.get('scorer') is not None:
+        return _calculate_neutrality_parallel(sequence, target_structure, options)
     accum = 0
     seq_length = len(sequence)
-    for i in range(0, seq_length):
-        for c in IUPAC.IUPAC_RNA_BASE:
-            if options.get('stop') is not None:
-                return 0.0
-            if sequence[i] != c:
-                new_seq = sequence[:i] + c + sequence[i + 1:]
-                structure = options.get('RNAfold').fold(new_seq)[options.get('fold')]
-                accum += bp_distance(structure, target_structure)
+    for new_seq in mutator.point_mutants(sequence):
+        if options.get('stop') is not None:
+            return 0.0
+        structure = options.get('RNAfold').fold(new_seq)[options.get('fold')]
+        budget.count_folds(options)
+        accum += bp_distance(structure, target_structure)
     return 1.0 - (accum / (pow(seq_length, 2) * 3.0))
 
 
+# calculate_neutrality with the point mutants folded on the options['scorer'] fold pool
+def _calculate_neutrality_parallel(sequence: str, target_structure: str, options: Dict[str, Any]):
+    fold_pool = options['scorer'].fold_pool
+    mutants = list(mutator.point_mutants(sequence))
+    accum = 0
+    chunk_size = fold_pool.workers * 4
+    for chunk_start in range(0, len(mutants), chunk_size):
+        if options.get('stop') is not None:
+            return 0.0
+        chunk = mutants[chunk_start:chunk_start + chunk_size]
+        budget.count_folds(options, len(chunk))
+        for fold_map in fold_pool.fold_many(chunk):
+            accum += bp_distance(fold_map[options.get('fold')], target_structure)
+    return 1.0 - (accum / (pow(len(sequence), 2) * 3.0))
+
+
+DEF_SCORE_MEMO_SIZE = 10000
+
+
+# Per design memo of visited sequences: sequence -> (match tree, score), stored in options['score_memo'].
+# options['score_memo_size'] sets the size, 0 turns it off.
+def start_score_memo(options: Dict[str, Any]) -> memo.LRUMemo:
+    memo_size = options.get('score_memo_size', DEF_SCORE_MEMO_SIZE)
+    score_memo = memo.LRUMemo(max_size=memo_size, enabled=memo_size > 0)
+    options['score_memo'] = score_memo
+    return score_memo
+
+
 def score_sequence(sequence: str, target_tree: tree_aligner.Tree, options: Dict[str, Any]):
+    score_memo = options.get('score_memo')
+    if score_memo is not None:
+        result = score_memo.get(sequence)
+        if result is not None:
+            return result
+    budget.count_folds(options)
+    result = _score_folded(sequence, options.get('RNAfold').fold(sequence), target_tree, options)
+    if score_memo is not None:
+        score_memo.put(sequence, result)
+    return result
+
+
+# Scores the sequences that are not in options['score_memo'] (each once) with score_func and returns the results of
+# all sequences in order
+def _score_memoized(sequences: List[str], options: Dict[str, Any], score_func):
+    score_memo = options.get('score_memo')
+    if score_memo is None:
+        return score_func(sequences)
+    results = {}
+    for sequence in sequences:
+        if sequence not in results:
+            results[sequence] = score_memo.get(sequence)
+    missing = [sequence for sequence, result in results.items() if result is None]
+    if missing:
+        for sequence, result in zip(missing, score_func(missing)):
+            results[sequence] = result
+            score_memo.put(sequence, result)
+    return [results[sequence] for sequence in sequences]
+
+
+# Scores a batch of sequences folded with a single fold_many call (concurrently if options['scorer'] is set)
+def score_batch(sequences: List[str], target_tree: tree_aligner.Tree, options: Dict[str, Any]):
+    if options.get('scorer') is not None:
+        return score_sequences(sequences, target_tree, options)
+
+    def score_folded_batch(batch: List[str]):
+        budget.count_folds(options, len(batch))
+        fold_maps = options.get('RNAfold').fold_many(batch)
+        return [_score_folded(sequence, fold_map, target_tree, options) for sequence, fold_map in zip(batch, fold_maps)]
+    return _score_memoized(sequences, options, score_folded_batch)
+
+
+def _score_folded(sequence: str, fold_map: Dict[str, Any], target_tree: tree_aligner.Tree, options: Dict[str, Any]):
     # Align score tree alignment + sequence alignment
-    fold_map = options.get('RNAfold').fold(sequence)
     structure = fold_map[options.get('fold')]
     tree, score = shapiro_tree_aligner.align_trees(shapiro_tree_aligner.get_tree(structure, sequence),
                                                    target_tree, options['alignment_rules'])
+    return tree, _add_fold_scores(sequence, fold_map, score, options)
+
+
+# Scores several sequences concurrently with options['scorer'] (parallel.CandidateScorer), same as score_sequence
+def score_sequences(sequences: List[str], target_tree: tree_aligner.Tree, options: Dict[str, Any]):
+    def score_many(batch: List[str]):
+        budget.count_folds(options, len(batch))
+        results = options['scorer'].score_many(batch, options.get('fold'), target_tree, options['alignment_rules'])
+        return [(tree, _add_fold_scores(sequence, fold_map, score, options))
+                for sequence, (fold_map, tree, score) in zip(batch, results)]
+    return _score_memoized(sequences, options, score_many)
+
+
+def _add_fold_scores(sequence: str, fold_map: Dict[str, Any], score, options: Dict[str, Any]):
+    structure = fold_map[options.get('fold')]
     # Add energy diff
     target_energy = options.get('target_energy')
     if target_energy is not None:
@@ -81,12 +160,15 @@ def score_sequence(sequence: str, target_tree: tree_aligner.Tree, options: Dict[
     target_neutrality = options.get('target_neutrality')
     if target_neutrality is not None:
         score += abs(calculate_neutrality(sequence, structure, options) - target_neutrality) * 100
-    return tree, score
+    return score
 
 
 class RnafbinvResult:
     def __init__(self, sequence: str, options: Dict[str, Any], calc_robusntess: bool=True):
         self.sequence = sequence
+        # budget spent by the design (before the folds of this result)
+        self.budget = str(options['budget']) if options.get('budget') is not None else None
+        self.budget_limited = options.get('budget') is not None and options['budget'].is_limited()
         fold_map = options.get('RNAfold').fold(sequence)
         self.fold_type = options.get('fold')
         self.energy = fold_map.get("{}_energy".format(options.get('fold')))
@@ -95,10 +177,10 @@ class RnafbinvResult:
             self.mutational_robustness = calculate_neutrality(self.sequence, self.structure, options)
         else:
             self.mutational_robustness = None
-        target_tree = shapiro_tree_aligner.get_tree(options['target_structure'], options['target_sequence'])
+        context = get_design_context(options)
         self.result_tree = shapiro_tree_aligner.get_tree(self.structure, self.sequence)
-        self.align_tree, self.score = shapiro_tree_aligner.align_trees(self.result_tree, target_tree,
-                                                                       options['alignment_rules'])
+        self.align_tree, self.score = shapiro_tree_aligner.align_trees(self.result_tree, context.result_tree,
+                                                                       context.alignment_rules)
         # Add energy diff
         target_energy = options.get('target_energy')
         if target_energy is not None:
@@ -108,7 +190,9 @@ class RnafbinvResult:
         if target_neutrality is not None:
             self.score += abs(calculate_neutrality(sequence, self.structure, options) - target_neutrality) * 100
         self.tree_edit_distance = tree_aligner.get_align_tree_distance(self.align_tree)
-        self.bp_dist = bp_distance(self.structure, options['target_structure'])
+        # distinct designs kept by the run (see elite.EliteArchive), [(sequence, score)] best first
+        self.elite = options['elite'].designs() if options.get('elite') is not None else []
+        self.bp_dist = context.structure.bp_distance(rna_structure.get_structure(self.structure))
 
     def __str__(self):
         print_data = "Result:\n{}\n{}\nFold energy: {}\nMutationa" \
@@ -116,6 +200,11 @@ class RnafbinvResult:
                      "Tree edit distance: {}\nResult tree: {}\nAligned tree ({}): {}" \
             .format(self.sequence, self.structure, self.energy, self.mutational_robustness, self.bp_dist,
                     self.tree_edit_distance, self.result_tree, self.score, self.align_tree)
+        if self.budget_limited:
+            print_data += "\nBudget spent: {}".format(self.budget)
+        if self.elite:
+            print_data += "\nElite designs:\n{}".format('\n'.join(["{}\t{}".format(sequence, score)
+                                                                   for sequence, score in self.elite]))
         return print_data
 
 
@@ -137,6 +226,128 @@ def calc_temp(iteration, max_iteration):
     return temp
 
 
+# Cooling schedule of the annealing loop: temperature(iteration, max_iteration) is called before the look ahead
+# and record(...) after each iteration. With reheat set, reheat iterations without a better best score restart the
+# schedule. Every recorded iteration is kept in stats as (iteration, temperature, accepted, current score, best score).
+class CoolingSchedule(ABC):
+    def __init__(self, reheat: int = None):
+        self.reheat = reheat
+        self.restart = 0
+        self.reheats = 0
+        self.stagnation = 0
+        self.best_score = None
+        self.last_score = None
+        self.stats = []
+
+    @abstractmethod
+    def temperature(self, iteration: int, max_iteration: int) -> float:
+        pass
+
+    def record(self, iteration: int, temperature: float, accepted: bool, current_score, best_score):
+        self.stats.append((iteration, temperature, accepted, current_score, best_score))
+        # score increases are the moves the temperature decides on (improving and neutral ones are always taken)
+        self._observe(self.last_score is not None and current_score > self.last_score)
+        self.last_score = current_score
+        if self.best_score is None or best_score < self.best_score:
+            self.best_score = best_score
+            self.stagnation = 0
+        else:
+            self.stagnation += 1
+        if self.reheat is not None and self.stagnation >= self.reheat:
+            self.restart = iteration + 1
+            self.stagnation = 0
+            self.reheats += 1
+            self._reheat()
+
+    def _observe(self, uphill: bool):
+        pass
+
+    def _reheat(self):
+        pass
+
+    # first recorded iteration that reached the final best score (None if nothing was recorded)
+    def iterations_to_best(self):
+        for iteration, _, _, _, best_score in self.stats:
+            if best_score == self.best_score:
+                return iteration + 1
+        return None
+
+    # json friendly state (without stats) for checkpoints
+    def get_state(self) -> Dict[str, Any]:
+        return {key: value for key, value in vars(self).items() if key != 'stats'}
+
+    def set_state(self, state: Dict[str, Any]):
+        vars(self).update(state)
+
+
+# calc_temp, restarted on reheat
+class LogarithmicSchedule(CoolingSchedule):
+    def temperature(self, iteration: int, max_iteration: int) -> float:
+        return calc_temp(max(iteration - self.restart, 0), max_iteration - self.restart)
+
+
+class LinearSchedule(CoolingSchedule):
+    def temperature(self, iteration: int, max_iteration: int) -> float:
+        span = max(max_iteration - self.restart, 1)
+        return max(max_iteration - max(iteration, self.restart), 0) * INITIAL_TEMP / span
+
+
+ADAPTIVE_START_ACCEPTANCE = 0.5
+ADAPTIVE_END_ACCEPTANCE = 0.02
+ADAPTIVE_GAIN = 1.0
+ADAPTIVE_WINDOW = 0.1
+MIN_TEMP = 0.001
+
+
+# Steers the temperature so the observed rate of accepted score increases (moving average over iterations) follows a
+# target curve that decays geometrically from ADAPTIVE_START_ACCEPTANCE to ADAPTIVE_END_ACCEPTANCE over the run,
+# independent of the score magnitudes of the target. Reheat sets the temperature back to INITIAL_TEMP and the curve to
+# its start.
+class AdaptiveSchedule(CoolingSchedule):
+    def __init__(self, reheat: int = None):
+        super().__init__(reheat)
+        self.current_temperature = INITIAL_TEMP
+        self.acceptance_rate = ADAPTIVE_START_ACCEPTANCE
+        self.target_rate = ADAPTIVE_START_ACCEPTANCE
+
+    def temperature(self, iteration: int, max_iteration: int) -> float:
+        progress = max(iteration - self.restart, 0) / max(max_iteration - self.restart, 1)
+        self.target_rate = ADAPTIVE_START_ACCEPTANCE * math.pow(ADAPTIVE_END_ACCEPTANCE / ADAPTIVE_START_ACCEPTANCE,
+                                                                min(progress, 1.0))
+        return self.current_temperature
+
+    def _observe(self, uphill: bool):
+        self.acceptance_rate += (float(uphill) - self.acceptance_rate) * ADAPTIVE_WINDOW
+        self.current_temperature *= math.exp(ADAPTIVE_GAIN * (self.target_rate - self.acceptance_rate))
+        self.current_temperature = min(max(self.current_temperature, MIN_TEMP), INITIAL_TEMP)
+
+    def _reheat(self):
+        self.current_temperature = INITIAL_TEMP
+        self.acceptance_rate = ADAPTIVE_START_ACCEPTANCE
+
+
+DEF_SCHEDULE = 'log'
+SCHEDULES = {
+    'log': LogarithmicSchedule,
+    'linear': LinearSchedule,
+    'adaptive': AdaptiveSchedule,
+}
+
+
+# schedule selected by options['schedule'] (calc_temp by default) with options['reheat']
+def make_schedule(options: Dict[str, Any]) -> CoolingSchedule:
+    return SCHEDULES[options.get('schedule', DEF_SCHEDULE)](options.get('reheat'))
+
+
+# tab separated per iteration statistics of a schedule
+def write_schedule_stats(path: str, schedule: CoolingSchedule):
+    with open(path, 'w') as stats_file:
+        stats_file.write('iteration\ttemperature\taccepted\tcurrent_score\tbest_score\n')
+        for iteration, temperature, accepted, current_score, best_score in schedule.stats:
+            stats_file.write('{}\t{}\t{}\t{}\t{}\n'.format(iteration + 1, temperature, int(accepted), current_score,
+                                                            best_score))
+
+
 def acceptance_probability(old_score, new_score, temperature, k):
     if new_score < old_score:
         return 1.0
@@ -147,56 +358,101 @@ def acceptance_probability(old_score, new_score, temperature, k):
         return math.exp(-diff / (k * temperature))
 
 
-def merge_motifs(target_tree, motifs):
-    def get_motif(motif_index):
-        for motif in motifs:
-            if motif.get('index') == motif_index:
-                return motif
-        return None
+# Offers a scored sequence to the elite archive of the design (options['elite']) if it has one
+def archive_design(sequence: str, score, options: Dict[str, Any]):
+    elite_archive = options.get('elite')
+    if elite_archive is not None:
+        elite_archive.add(sequence, score)
+
 
-    tree_stack = [target_tree]
-    index = 0
-    while tree_stack:
-        top = tree_stack.pop()
-        for child in top.children[::-1]:
-            tree_stack.append(child)
-        found_motif = get_motif(index)
-        if found_motif is not None:
-            if top.value.size == found_motif.get('length') and \
-                    top.value.name == found_motif.get('name'):
-                top.value.preserve = True
-            else:
-                return False
-        index += 1
-    return True
+# Look ahead with all mutants and their acceptance draws generated up front (same random calls as the serial loop),
+# scored in waves of options['scorer'].workers candidates. The first accepted candidate in the serial order wins and
+# the random state (and base draws) is restored to right after its draw so the run matches the serial loop.
+# Returns (progress, sequence, tree, score) or None if stopped.
+def parallel_look_ahead(current_sequence: str, current_score, match_tree: tree_aligner.Tree,
+                        target_tree: tree_aligner.Tree, temperature: float, options: Dict[str, Any]):
+    rng = mutator.get_random(options)
+    candidates = []
+    for look_ahead in range(0, options.get('look_ahead')):
+        new_sequence = mutator.perturbate(current_sequence, match_tree, options)
+        move = mutator.last_move(options)
+        draw = rng.random()
+        draws_state = options['base_draws'].snapshot() if options.get('base_draws') is not None else None
+        candidates.append((new_sequence, move, draw, rng.getstate(), draws_state))
+    wave_size = max(1, options['scorer'].workers)
+    for wave_start in range(0, len(candidates), wave_size):
+        if options.get('stop') is not None:
+            return None
+        if budget.get_budget(options).expired():
+            break
+        wave = candidates[wave_start:wave_start + wave_size]
+        scores = score_sequences([candidate[0] for candidate in wave], target_tree, options)
+        for (new_sequence, move, draw, random_state, draws_state), (new_tree, new_score) in zip(wave, scores):
+            probability = acceptance_probability(current_score, new_score, temperature, len(current_sequence))
+            options.get('logger').debug("TEMP: {} PROBABILITY: {}".format(temperature, probability))
+            archive_design(new_sequence, new_score, options)
+            mutator.record_move(options, move, draw < probability, draw < probability and new_score < current_score)
+            if draw < probability:
+                rng.setstate(random_state)
+                if draws_state is not None:
+                    options['base_draws'].restore(draws_state)
+                return True, new_sequence, new_tree, new_score
+    return False, current_sequence, match_tree, current_score
 
 
-def simulated_annealing(options: Dict[str, Any]):
-    if len(options) == 0:
-        options.get('logger').fatal("Options object was not properly initiated. ")
+# The design context of the options target (see design_context.DesignContext), reused from
+# options['design_context'] when it was built for the same target. None if the motifs do not match.
+def get_design_context(options: Dict[str, Any]):
+    context = options.get('design_context')
+    if context is None or not context.matches(options):
+        try:
+            context = design_context.DesignContext.from_options(options)
+        except ValueError as e:
+            logging.error(str(e))
+            return None
+        options['design_context'] = context
+    return context
+
+
+# Sets the alignment rules (and options['constraints']) and returns the target tree with preserved motifs (None if the
+# motifs do not match)
+def prepare_target(options: Dict[str, Any]):
+    context = get_design_context(options)
+    if context is None:
+        return None
+    options['alignment_rules'] = context.alignment_rules
+    options['constraints'] = context.constraints
+    if context.constraints is not None:
+        options.get('logger').info('Sequence constraints: {}'.format(context.constraints))
+    return context.target_tree
+
+
+# Shared design setup: target (see prepare_target), rng seed and starting sequence (RNAinverse / random).
+# Returns (starting sequence, target tree) or None on failure.
+def initialize_design(options: Dict[str, Any]):
+    target_tree = prepare_target(options)
+    if target_tree is None:
         return None
-    alignment_rules = tree_aligner.AlignmentRules(
-        delete_func=lambda tree_value, is_target: shapiro_tree_aligner.delete_shapiro_func(tree_value, is_target,
-                                                                                           options['reduced_bi']),
-        cmp_func=shapiro_tree_aligner.cmp_shapiro_tree_values,
-        merge_func=shapiro_tree_aligner.merge_shapiro_tree_values,
-        minmax_func=min)
-    options['alignment_rules'] = alignment_rules
     # init rng
+    rng = mutator.get_random(options)
     rng_seed = options.get('rng')
     if rng_seed is not None:
-        random.seed(rng_seed)
-    # init loop variables
-    no_iterations = options.get('iter')
-    no_lookahead = options.get('look_ahead')
+        rng.seed(rng_seed)
+    # opt in block base draws, seeded from the run's random stream
+    options['base_draws'] = mutator.BaseDraws(rng.getrandbits(64)) if options.get('block_draws') else None
     # init initial sequence
     current_sequence = options.get('starting_sequence')
     if current_sequence is None:
         if options.get('random'):
             current_sequence = generate_random_start(len(options['target_structure']),
-                                                     options['target_sequence'].replace('T', 'U'))
+                                                     options['target_sequence'].replace('T', 'U'),
+                                                     options['constraints'], options['base_draws'], rng)
     else:
         current_sequence = current_sequence.replace('T', 'U')
+        # options['exact_start'] starts from the starting sequence itself (wildcards resolved), not from RNAinverse
+        if options.get('exact_start'):
+            return generate_random_start(len(current_sequence), current_sequence, options['constraints'],
+                                         options['base_draws'], rng), target_tree
     # Vienna starts the process
     vienna_sequence = vienna.inverse(options['target_structure'], vienna.inverse_seq_ready(options['target_sequence'],
                                                                                            current_sequence))
@@ -204,57 +460,159 @@ def simulated_annealing(options: Dict[str, Any]):
     if vienna_sequence is None or vienna_sequence == '':
         if options.get('starting_sequence') is None:
             current_sequence = generate_random_start(len(options['target_structure']),
-                                                     options['target_sequence'].replace('T', 'U'))
+                                                     options['target_sequence'].replace('T', 'U'),
+                                                     options['constraints'], options['base_draws'], rng)
         else:
             current_sequence = generate_random_start(len(options['target_structure']),
-                                                     options.get('starting_sequence').replace('T', 'U'))
+                                                     options.get('starting_sequence').replace('T', 'U'),
+                                                     options['constraints'], options['base_draws'], rng)
     else:
         current_sequence = generate_random_start(len(options['target_structure']),
-                                                 vienna_sequence.upper().replace('T', 'U'))
+                                                 vienna_sequence.upper().replace('T', 'U'),
+                                                 options['constraints'], options['base_draws'], rng)
     #print("Structure: {}\nsequence: {}\nstart: {}\ninverse: {}".format(options['target_structure'],
     #                                                                   options['target_sequence'],
     #                                                                   options.get('starting_sequence'),
     #                                                                   current_sequence))
-    final_result = current_sequence
-    # setup target tree and get initial sequence score (and max score)
-    target_tree = shapiro_tree_aligner.get_tree(options['target_structure'], options['target_sequence'])
-    if not merge_motifs(target_tree, options.get('motifs')):
-        shapiro_str = shapiro_generator.get_shapiro(options['target_structure']).shapiro
-        logging.error('Motif list does not match target structure {}\nTarget Shapiro:{}'.format(options.get('motifs'),
-                                                                                                shapiro_str))
+    return current_sequence, target_tree
+
+
+DEF_CHECKPOINT_INTERVAL = 10
+
+
+# Atomically (temporary file + rename) writes a compact json checkpoint
+def write_checkpoint(path: str, state: Dict[str, Any]):
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp',
+                                     delete=False) as temp_file:
+        json.dump(state, temp_file, separators=(',', ':'))
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_file.name, path)
+
+
+def read_checkpoint(path: str) -> Dict[str, Any]:
+    with open(path) as checkpoint_file:
+        state = json.load(checkpoint_file)
+    version, internal_state, gauss_next = state['random_state']
+    state['random_state'] = (version, tuple(internal_state), gauss_next)
+    return state
+
+
+# Annealing state after a finished iteration, the current match tree and score are recomputed on resume
+def _annealing_checkpoint(iteration: int, current_sequence: str, final_result: str, best_score,
+                          schedule: CoolingSchedule, options: Dict[str, Any]) -> Dict[str, Any]:
+    moves = options.get('moves')
+    base_draws = options.get('base_draws')
+    elite_archive = options.get('elite')
+    return {'iteration': iteration, 'current_sequence': current_sequence, 'best_sequence': final_result,
+            'best_score': best_score, 'random_state': mutator.get_random(options).getstate(),
+            'schedule': schedule.get_state(), 'moves': moves.get_state() if moves is not None else None,
+            'base_draws': base_draws.get_state() if base_draws is not None else None,
+            'elite': elite_archive.get_state() if elite_archive is not None else None,
+            'target_structure': options['target_structure'], 'target_sequence': options['target_sequence']}
+
+
+def simulated_annealing(options: Dict[str, Any]):
+    if len(options) == 0:
+        options.get('logger').fatal("Options object was not properly initiated. ")
         return None
-    _, optimal_score = shapiro_tree_aligner.align_trees(target_tree, target_tree, options['alignment_rules'])
+    start_iteration = 0
+    resume_state = None
+    if options.get('resume') is not None:
+        resume_state = read_checkpoint(options['resume'])
+        if resume_state['target_structure'] != options['target_structure'] or \
+                resume_state['target_sequence'] != options['target_sequence']:
+            options.get('logger').error('Checkpoint {} was written for a different target'.format(options['resume']))
+            return None
+        target_tree = prepare_target(options)
+        if target_tree is None:
+            return None
+        current_sequence = resume_state['current_sequence']
+        start_iteration = resume_state['iteration']
+        mutator.get_random(options).setstate(resume_state['random_state'])
+        options['base_draws'] = None
+        if resume_state.get('base_draws') is not None:
+            options['base_draws'] = mutator.BaseDraws(0)
+            options['base_draws'].set_state(resume_state['base_draws'])
+    else:
+        design_start = initialize_design(options)
+        if design_start is None:
+            return None
+        current_sequence, target_tree = design_start
+    final_result = current_sequence
+    # init loop variables
+    no_iterations = options.get('iter')
+    no_lookahead = options.get('look_ahead')
+    checkpoint_path = options.get('checkpoint')
+    checkpoint_interval = max(1, options.get('checkpoint_interval', DEF_CHECKPOINT_INTERVAL))
+    design_budget = budget.get_budget(options)
+    schedule = make_schedule(options)
+    options['moves'] = mutator.AdaptiveMoves() if options.get('adaptive_moves') else None
+    options['elite'] = None
+    if options.get('elite_size'):
+        options['elite'] = elite.EliteArchive(options['elite_size'],
+                                              options.get('elite_distance', elite.DEF_ELITE_DISTANCE))
+    # initial sequence score
     match_tree, current_score = score_sequence(current_sequence, target_tree, options)
     best_score = current_score
+    if resume_state is not None:
+        final_result = resume_state['best_sequence']
+        best_score = resume_state['best_score']
+        schedule.set_state(resume_state.get('schedule', {}))
+        if options['moves'] is not None and resume_state.get('moves') is not None:
+            options['moves'].set_state(resume_state['moves'])
+        if options['elite'] is not None and resume_state.get('elite') is not None:
+            options['elite'].set_state(resume_state['elite'])
+        options.get('logger').info('Resuming at iteration {} ({}): {}'.format(start_iteration + 1, current_score,
+                                                                               current_sequence))
+    else:
+        archive_design(current_sequence, current_score, options)
     options.get('logger').info('Initial sequence ({}): {}\nAlign tree: {}'.format(current_score, current_sequence, match_tree))
     updater = options.get('updater')
     # main loop
-    for iter in range(0, no_iterations):
+    for iter in range(start_iteration, no_iterations):
         if options.get('stop') is not None:
             return None
         if best_score == 0:
             break
+        if design_budget.expired():
+            options.get('logger').info('Budget expired at iteration {}: {}'.format(iter + 1, design_budget))
+            break
         progress = False
-        for look_ahead in range(0, no_lookahead):
-            if options.get('stop') is not None:
+        # the schedule follows the iterations or the spent budget (whichever is further)
+        temperature = schedule.temperature(budget.budget_iteration(iter, no_iterations, options), no_iterations)
+        if options.get('scorer') is not None:
+            look_ahead_result = parallel_look_ahead(current_sequence, current_score, match_tree, target_tree,
+                                                    temperature, options)
+            if look_ahead_result is None:
                 return None
-            new_sequence = mutator.perturbate(current_sequence, match_tree, options)
-            new_tree, new_score = score_sequence(new_sequence, target_tree, options)
-            temperature = calc_temp(iter, no_iterations)
-            probability = acceptance_probability(current_score, new_score, temperature, len(current_sequence))
-            options.get('logger').debug("iteration {} - TEMP: {} PROBABILITY: {}".format(iter + 1, temperature,
-                                                                                         probability))
-            if random.random() < probability:
-                progress = True
-                break
-            ''' OLD method, decays very fast (new is boltzman probability)
-            if new_score < current_score:
-                progress = True
-                break
-            elif random.random() < (2.0 / (iter + 1.0) / no_lookahead):
-                progress = True
-                break
-            '''
+            progress, new_sequence, new_tree, new_score = look_ahead_result
+        else:
+            for look_ahead in range(0, no_lookahead):
+                if options.get('stop') is not None:
+                    return None
+                if design_budget.expired():
+                    break
+                new_sequence = mutator.perturbate(current_sequence, match_tree, options)
+                new_tree, new_score = score_sequence(new_sequence, target_tree, options)
+                archive_design(new_sequence, new_score, options)
+                probability = acceptance_probability(current_score, new_score, temperature, len(current_sequence))
+                options.get('logger').debug("iteration {} - TEMP: {} PROBABILITY: {}".format(iter + 1, temperature,
+                                                                                             probability))
+                accepted = mutator.get_random(options).random() < probability
+                mutator.record_move(options, mutator.last_move(options), accepted,
+                                    accepted and new_score < current_score)
+                if accepted:
+                    progress = True
+                    break
+                ''' OLD method, decays very fast (new is boltzman probability)
+                if new_score < current_score:
+                    progress = True
+                    break
+                elif random.random() < (2.0 / (iter + 1.0) / no_lookahead):
+                    progress = True
+                    break
+                '''
         if progress:
             current_sequence = new_sequence
             current_score = new_score
@@ -262,10 +620,31 @@ def simulated_annealing(options: Dict[str, Any]):
         if current_score <= best_score:
             best_score = current_score
             final_result = current_sequence
+        schedule.record(iter, temperature, progress, current_score, best_score)
+        if options['moves'] is not None:
+            options['moves'].commit()
         options.get('logger').debug('Iteration {} current sequence ({}): {}\nAlign tree: {}'.format(iter + 1, current_score,
                                                                                     current_sequence, match_tree))
         if updater is not None:
             updater.update(iter + 1)
+        if checkpoint_path is not None and (iter + 1) % checkpoint_interval == 0:
+            write_checkpoint(checkpoint_path, _annealing_checkpoint(iter + 1, current_sequence, final_result,
+                                                                    best_score, schedule, options))
     # final print
-
+    options.get('logger').info('Budget spent: {}'.format(design_budget))
+    options.get('logger').info('Schedule {}: best score {} at iteration {}, {} reheats'.format(
+        options.get('schedule', DEF_SCHEDULE), best_score, schedule.iterations_to_best(), schedule.reheats))
+    if options.get('schedule_stats') is not None:
+        write_schedule_stats(options['schedule_stats'], schedule)
+    if options['moves'] is not None:
+        options.get('logger').info('Move distribution (probability (tries/accepted/improved)): {}'.format(
+            options['moves']))
+    if options['elite'] is not None:
+        # the returned design always heads the archive (a tied candidate that was scored later but not accepted would
+        # otherwise take its place)
+        archive_design(final_result, best_score, options)
+        options.get('logger').info('Elite archive: {}'.format(options['elite']))
+    options.get('logger').debug('Alignment memo usage: {}'.format(shapiro_tree_aligner.get_alignment_memo_stats()))
+    if options.get('score_memo') is not None:
+        options.get('logger').info('Visited sequence memo: {}'.format(options['score_memo']))
     return final_result
@@ -4,7 +4,7 @@ Also builds an index list for each motif
 '''
 
 
-import logging
+from rnafbinv import rna_structure
 
 
 # Object including structure, shapiro and list of sequence indexes for each shapiro motif
@@ -45,38 +45,16 @@ def _get_indexes(orig_map_list, arr_index):
 
 # generate map of closing index to bracket
 def _get_closure_map(structure):
-    closure_map = {}
-    tracking_stack = []
-    for i in range(0, len(structure)):
-        if structure[i] == '(':
-            tracking_stack.append(i)
-        elif structure[i] == ')':
-            closure_map[i] = tracking_stack.pop()
-    return closure_map
+    pair_table = rna_structure.get_structure(structure).pair_table
+    return {index: partner for index, partner in enumerate(pair_table.tolist()) if index > partner >= 0}
 
 
 # Create a string representation of dot bracket where outer parenthesis are marked with square bracket as a list
 def _get_aux_list(structure):
-    aux_array = list(structure)
-    match_paren = [0] * len(structure)  # list of matching parenthesis
-    index = 0  # current index in structure
-    o = 0  # depth of open parenthesis
-    while index < len(aux_array):
-        if aux_array[index] == '(':
-            o += 1
-            match_paren[o] = index
-        elif aux_array[index] == ')':
-            p = index  # tracking inner closers
-            while p + 1 < len(aux_array) and aux_array[p + 1] == ')' and match_paren[o - 1] == match_paren[o] - 1:
-                p += 1
-                o -= 1
-            aux_array[p] = ']'
-            index = p
-            aux_array[match_paren[o]] = '['
-            o -= 1
-        elif aux_array[index] != '.':
-            logging.error("Unknown element in dot bracket element: '{}'".format(aux_array[index]))
-        index += 1
+    aux_array = list(str(structure))
+    for start, end, _ in rna_structure.get_structure(structure).helices:
+        aux_array[start] = '['
+        aux_array[end] = ']'
     return aux_array
 
 
@@ -2,7 +2,10 @@
 Specific AligjnmentRules for shapiro values in the tree alignments
 '''
 
-from rnafbinv import shapiro_generator, tree_aligner, IUPAC
+from rnafbinv import shapiro_generator, tree_aligner, IUPAC, memo, rna_structure
+from typing import List, Tuple
+import collections.abc
+import functools
 import logging
 
 
@@ -23,28 +26,130 @@ def ins_align_lower(s1, i1, s2, i2):
         return 1
 
 
-DEFAULT_ALIGNMENT_SCORE = IUPAC.SequenceAlignmentScore(
+DEFAULT_ALIGNMENT_SCORE = IUPAC.VectorizedAlignmentScore(
     minmax_func=min,
-    match_func=lambda s1, i1, s2, i2: IUPAC.agree(s1[i1], s2[i2], 0, 0, 1000),
+    match_score_N=0, match_score=0, mismatch_penalty=1000,
     delete_func=del_align_lower,
     insert_func=ins_align_lower)
 
 
-def align_single_seq(seq_one: str, seq_two: str):
-    alignment_matrix = IUPAC.align_iupac_dna_sequence(seq_one, seq_two,
-                                                      sequence_alignment_score=DEFAULT_ALIGNMENT_SCORE)
-    best_score = IUPAC.get_best_score(alignment_matrix)
-    best_alignment = IUPAC.generate_optimal_alignments(seq_one, seq_two, return_single=True,
-                                                       score_matrix=alignment_matrix,
-                                                       sequence_alignment_score=DEFAULT_ALIGNMENT_SCORE)
-    # We generate single optimal alignment
-    best_alignment = best_alignment[0]
+# Alignments only depend on the two sequences (DEFAULT_ALIGNMENT_SCORE is fixed), same segments and node sequences
+# are aligned many times within a tree alignment and across design iterations
+SINGLE_SEQ_MEMO = memo.LRUMemo(max_size=200000)
+SEQUENCES_MEMO = memo.LRUMemo(max_size=50000)
+
+
+# Turn alignment memos on / off and optionally change their size
+def set_alignment_memo(enabled: bool = True, single_seq_size: int = None, sequences_size: int = None):
+    for alignment_memo, size in ((SINGLE_SEQ_MEMO, single_seq_size), (SEQUENCES_MEMO, sequences_size)):
+        alignment_memo.enabled = enabled
+        if size is not None:
+            alignment_memo.resize(size)
+        if not enabled:
+            alignment_memo.clear()
+
+
+def get_alignment_memo_stats() -> str:
+    return "single sequence memo: {}, sequences memo: {}, structure memo: {}".format(SINGLE_SEQ_MEMO, SEQUENCES_MEMO,
+                                                                                  STRUCTURE_MEMO)
+
+
+# Returns the score and a single optimal alignment, in score only mode the alignment may be None
+def align_single_seq(seq_one: str, seq_two: str, score_only: bool = False):
+    result = SINGLE_SEQ_MEMO.get((seq_one, seq_two))
+    if result is None or (result[1] is None and not score_only):
+        result = _align_single_seq(seq_one, seq_two, score_only)
+        SINGLE_SEQ_MEMO.put((seq_one, seq_two), result)
+    return result
+
+
+def _align_single_seq(seq_one: str, seq_two: str, score_only: bool = False):
+    result = _align_unconstrained(seq_one, seq_two)
+    if result is None:
+        result = _align_single_seq_dp(seq_one, seq_two, score_only)
+    return result
+
+
+# Closed form DEFAULT_ALIGNMENT_SCORE alignment when one side is empty or the target segment is unconstrained
+# (all 'N'). Every base matches N for free and every gap costs 1 so the score is the length difference.
+# The alignment is the one the DP traceback selects (matches first, leftover gaps at the start).
+# Returns None if the segments are not of that form.
+def _align_unconstrained(seq_one: str, seq_two: str):
+    if seq_two == '':
+        return len(seq_one), (seq_one, '-' * len(seq_one))
+    if seq_one == '':
+        score = 0
+        for two_index in range(0, len(seq_two)):
+            delete_penalty = del_align_lower(seq_one, 0, seq_two, two_index)
+            if delete_penalty is None:
+                return None
+            score += delete_penalty
+        return score, ('-' * len(seq_two), seq_two)
+    if seq_two.count('N') != len(seq_two) or '.' in seq_one or \
+            not all(IUPAC.IUPAC_MASK_MAP.get(c.upper()) for c in seq_one):
+        return None
+    if len(seq_one) >= len(seq_two):
+        return len(seq_one) - len(seq_two), (seq_one, '-' * (len(seq_one) - len(seq_two)) + seq_two)
+    return len(seq_two) - len(seq_one), ('-' * (len(seq_two) - len(seq_one)) + seq_one, seq_two)
+
+
+def _align_single_seq_dp(seq_one: str, seq_two: str, score_only: bool = False):
+    if score_only:
+        return IUPAC.get_alignment_score(seq_one, seq_two, sequence_alignment_score=DEFAULT_ALIGNMENT_SCORE), None
+    # We generate single optimal alignment (in linear space for long segments)
+    best_score, best_alignment = IUPAC.get_optimal_alignment(seq_one, seq_two,
+                                                             sequence_alignment_score=DEFAULT_ALIGNMENT_SCORE)
     #logging.debug("Aligning '{}' to '{}' (Score: {})\nresult: {}".format(seq_one, seq_two, best_score, best_alignment))
     return best_score, best_alignment
 
 
+# Alignment list of two node sequences that is only calculated when it is used (printed, iterated or indexed).
+# Returned by score only alignments, most compared node pairs never make it to the final aligned tree.
+class LazyAlignment(collections.abc.Sequence):
+    def __init__(self, sequence_one: str, sequence_two: str, alignment: List[Tuple[str, str]] = None):
+        self.sequence_one = sequence_one
+        self.sequence_two = sequence_two
+        self._alignment = alignment
+
+    @property
+    def alignment(self) -> List[Tuple[str, str]]:
+        if self._alignment is None:
+            self._alignment = align_sequences(self.sequence_one, self.sequence_two)[1]
+        return self._alignment
+
+    def __getitem__(self, item):
+        return self.alignment[item]
+
+    def __len__(self):
+        return len(self.alignment)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyAlignment):
+            other = other.alignment
+        return self.alignment == other
+
+    def __str__(self):
+        return str(self.alignment)
+
+    def __repr__(self):
+        return repr(self.alignment)
+
+
 # aligns list of sequences. list is generated by splitting the sequences whenever a '.' is found
-def align_sequences(sequence_one: str, sequence_two: str):
+# in score only mode the alignment is a LazyAlignment which is calculated on first use
+def align_sequences(sequence_one: str, sequence_two: str, score_only: bool = False):
+    result = SEQUENCES_MEMO.get((sequence_one, sequence_two))
+    if result is None or (result[1] is None and not score_only):
+        result = _align_sequences(sequence_one, sequence_two, score_only)
+        SEQUENCES_MEMO.put((sequence_one, sequence_two), result)
+    # callers get their own alignment list
+    alignment = list(result[1]) if result[1] is not None else None
+    if score_only:
+        return result[0], LazyAlignment(sequence_one, sequence_two, alignment)
+    return result[0], alignment
+
+
+def _align_sequences(sequence_one: str, sequence_two: str, score_only: bool = False):
     def retrace(score_matrix, transition_matrix):
         alignment_list = []
         one_index = len(score_matrix) - 1
@@ -67,7 +172,8 @@ def align_sequences(sequence_one: str, sequence_two: str):
             else:
                 raise IUPAC.IUPACAlignmentError("Score matrix, no match!\n{}[{}][{}] {}"
                                                 .format(score_matrix, one_index, two_index, transition_pair[0]))
-            alignment_list.append(transition_pair[1])
+            # segment alignment strings are only generated for the selected transitions
+            alignment_list.append(align_single_seq(*transition_pair[1])[1])
         return alignment_list
 
     seqs_one = sequence_one.split('.')
@@ -82,22 +188,27 @@ def align_sequences(sequence_one: str, sequence_two: str):
             score_list = []
             # match
             if one_index > 0 and two_index > 0:
-                calc_score, alignment = align_single_seq(seqs_one[one_index - 1], seqs_two[two_index - 1])
-                transition_list.append((calc_score, alignment))
+                segments = (seqs_one[one_index - 1], seqs_two[two_index - 1])
+                calc_score = align_single_seq(*segments, score_only=True)[0]
+                transition_list.append((calc_score, segments))
                 score_list.append(calc_score + score_matrix[one_index - 1][two_index - 1])
             # insert
             if one_index > 0:
-                calc_score, alignment = align_single_seq(seqs_one[one_index - 1], '')
-                transition_list.append((calc_score, alignment))
+                segments = (seqs_one[one_index - 1], '')
+                calc_score = align_single_seq(*segments, score_only=True)[0]
+                transition_list.append((calc_score, segments))
                 score_list.append(calc_score + score_matrix[one_index - 1][two_index])
             # delete
             if two_index > 0:
-                calc_score, alignment = align_single_seq('', seqs_two[two_index - 1])
-                transition_list.append((calc_score, alignment))
+                segments = ('', seqs_two[two_index - 1])
+                calc_score = align_single_seq(*segments, score_only=True)[0]
+                transition_list.append((calc_score, segments))
                 score_list.append(calc_score + score_matrix[one_index][two_index - 1])
             max_value = min(score_list)
             transition_matrix[one_index][two_index] = transition_list[score_list.index(max_value)]
             score_matrix[one_index][two_index] = max_value
+    if score_only:
+        return score_matrix[one_index][two_index], None
     return score_matrix[one_index][two_index], retrace(score_matrix, transition_matrix)
 
 
@@ -105,16 +216,18 @@ REDUCED_MOTIFS = 'BI'
 LOOP_MOTIFS = 'HM' + REDUCED_MOTIFS
 
 
-def cmp_shapiro_tree_values(value_one, value_two):
+def cmp_shapiro_tree_values(value_one, value_two, score_only=False):
     result = None
     alignment = []
     if (value_two.preserve and value_one.name == value_two.name and value_one.size == value_two.size) or \
             (not value_two.preserve and (value_one.name == value_two.name or
                                          (value_one.name in LOOP_MOTIFS and value_two.name in LOOP_MOTIFS))):
-        score, alignment = align_sequences(value_one.sequence, value_two.sequence)
+        score, alignment = align_sequences(value_one.sequence, value_two.sequence, score_only)
         result = score
-    logging.debug("{}matched {} - {}, score {} alignment {}".format('====PRESERVE====' if value_two.preserve else '',
-                                                                    value_one, value_two, result, alignment))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("{}matched {} - {}, score {} alignment {}".format('====PRESERVE====' if value_two.preserve
+                                                                        else '', value_one, value_two, result,
+                                                                        alignment))
     return result, alignment
 
 
@@ -122,22 +235,32 @@ def merge_shapiro_tree_values(value_one, value_two):
     return value_one
 
 
-def delete_shapiro_func(value, is_target=False, reduced_min_bi=0):
+def delete_shapiro_func(value, is_target=False, reduced_min_bi=0, score_only=False):
     if is_target:
-        score, align = align_sequences('', value.sequence)
+        score, align = align_sequences('', value.sequence, score_only)
         if value.preserve:
             score += 1000
         elif not (value.name in REDUCED_MOTIFS and value.size <= reduced_min_bi):
             score += 100
     else:
-        score, align = align_sequences(value.sequence, '')
+        score, align = align_sequences(value.sequence, '', score_only)
         if not (value.name in REDUCED_MOTIFS and value.size <= reduced_min_bi):
             score += 100
-    logging.debug("{}delete {} {} score {}".format('====PRESERVE====' if value.preserve and is_target else '',
-                  value, '(Target)' if is_target else '', score))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("{}delete {} {} score {}".format('====PRESERVE====' if value.preserve and is_target else '',
+                      value, '(Target)' if is_target else '', score))
     return score, align
 
 
+# Shapiro alignment rules. score only rules compute node alignments lazily (only when used in the final tree)
+def get_alignment_rules(reduced_min_bi: int = 0, score_only: bool = False) -> tree_aligner.AlignmentRules:
+    return tree_aligner.AlignmentRules(
+        delete_func=functools.partial(delete_shapiro_func, reduced_min_bi=reduced_min_bi, score_only=score_only),
+        cmp_func=functools.partial(cmp_shapiro_tree_values, score_only=score_only),
+        merge_func=merge_shapiro_tree_values,
+        minmax_func=min)
+
+
 # recursively turn a shapiro string into a tree
 def shapiro_to_tree(shapiro_str, shapiro_index, sequence):
     str_index = len(shapiro_str) - 1
@@ -184,6 +307,22 @@ def shapiro_to_tree(shapiro_str, shapiro_index, sequence):
     return res_tree
 
 
+# (start, end) slices of consecutive runs in a sorted index list
+def _index_ranges(index_list):
+    ranges = []
+    for index in index_list:
+        if ranges and index == ranges[-1][1]:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return tuple((start, end) for start, end in ranges)
+
+
+# sequence of sorted indexes, consecutive indexes are joined and segments separated by '.'
+def _segments_sequence(index_list, sequence):
+    return ".".join([sequence[start:end] for start, end in _index_ranges(index_list)])
+
+
 class ShapiroTreeValue:
     def __init__(self, shapiro_str_name, shapiro_index, sequence):
         self.name = shapiro_str_name[0]
@@ -209,33 +348,97 @@ class ShapiroTreeValue:
                                                                                                      shapiro_index,
                                                                                                      sequence))
             self.index_list.sort()
-            indexes = []
-            last = None
-            current = []
-            for index in self.index_list:
-                if last is None or index == last + 1:
-                    current.append(index)
-                else:
-                    indexes.append(current)
-                    current = [index]
-                last = index
-            indexes.append(current)
-            self.sequence = ".".join(["".join([sequence[index] for index in group]) for group in indexes])
+            self.sequence = _segments_sequence(self.index_list, sequence)
+
+    # builds the value directly from motif name, size and sequence indexes (no shapiro string parsing)
+    # ranges are the (start, end) slices of consecutive indexes, computed from index_list if not given
+    @classmethod
+    def from_index_list(cls, name, size, index_list, sequence, ranges=None):
+        value = cls.__new__(cls)
+        value.name = name
+        value.preserve = False
+        value.size = size
+        if size == 0:
+            value.index_list = []
+            value.sequence = ''
+        else:
+            value.index_list = sorted(index_list)
+            if ranges is None:
+                ranges = _index_ranges(value.index_list)
+            value.sequence = ".".join([sequence[start:end] for start, end in ranges])
+        return value
 
     def __str__(self):
         return "{}{}({})".format(self.name, self.size, self.sequence)
 
-    '''
-    def __init__(self, name, size, index_list):
-        self.name = name
-        self.size = size
-        self.index_list = index_list
-    '''
+
+# Sequence independent shapiro decomposition of a dot bracket structure (same tree as parsing get_shapiro strings
+# with shapiro_to_tree, including the reversed order of children).
+# Every node is a (name, size, index list, index ranges, children) tuple.
+def get_structure_shape(structure):
+    def node(name, size, index_list, children):
+        index_list = tuple(sorted(index_list)) if size > 0 else ()
+        return name, size, index_list, _index_ranges(index_list), tuple(children)
+
+    structure = rna_structure.get_structure(structure)
+    helix_nodes = [None] * len(structure.helices)
+    # enclosed helices start after the helix enclosing them
+    for helix_index in range(len(structure.helices) - 1, -1, -1):
+        start, end, length = structure.helices[helix_index]
+        unpaired, children = structure.helix_loops[helix_index]
+        if len(children) == 0:
+            name = 'H'  # hairpin
+        elif len(children) == 1:
+            child_start, child_end, _ = structure.helices[children[0]]
+            # no unpaired bases on one side of the loop
+            is_bulge = child_start == start + length or child_end == end - length
+            name = 'B' if is_bulge else 'I'  # bulge or internal loop
+        else:
+            name = 'M'  # multi loop
+        loop_node = node(name, len(unpaired), unpaired, [helix_nodes[child] for child in children[::-1]])
+        stem_indexes = list(range(start, start + length)) + list(range(end - length + 1, end + 1))
+        helix_nodes[helix_index] = node('S', length, stem_indexes, [loop_node])
+    unpaired, children = structure.exterior_loop
+    root_children = [helix_nodes[child] for child in children[::-1]]
+    if unpaired:
+        root_children = [node('E', len(unpaired), unpaired, root_children)]
+    return node('R', 0, [], root_children)
+
+
+# Attach a sequence to a structure shape (see get_structure_shape)
+def shape_to_tree(shape, sequence):
+    def new_tree(node):
+        name, size, index_list, ranges, _ = node
+        return tree_aligner.Tree(ShapiroTreeValue.from_index_list(name, size, index_list, sequence, ranges), [])
+
+    root = new_tree(shape)
+    build_stack = [(shape, root)]
+    while build_stack:
+        node, tree = build_stack.pop()
+        for child_node in node[4]:
+            child_tree = new_tree(child_node)
+            tree.add_child(child_tree)
+            build_stack.append((child_node, child_tree))
+    return root
+
+
+# Builds the shapiro tree of a dot bracket structure without going through the shapiro strings
+def structure_to_tree(structure, sequence):
+    return shape_to_tree(get_structure_shape(structure), sequence)
+
+
+# Candidate sequences often fold into the same structure, the sequence independent part of the tree is kept per
+# structure (shared by scoring, motif listing and motif merging through get_tree)
+STRUCTURE_MEMO = memo.LRUMemo(max_size=10000)
 
 
+# The shapiro string form (get_shapiro) is only needed for display
 def get_tree(structure, sequence):
-    shapiro = shapiro_generator.get_shapiro(structure)
-    return shapiro_to_tree(shapiro.shapiro, shapiro.shapiro_indexes, sequence)
+    shape = STRUCTURE_MEMO.get(structure)
+    if shape is None:
+        shape = get_structure_shape(structure)
+        STRUCTURE_MEMO.put(structure, shape)
+    return shape_to_tree(shape, sequence)
 
 
 def align_trees(tree_source, tree_target,
@@ -292,10 +495,106 @@ def get_matching_indexes(aligned_tree):
     return matching_index, unmatching_index
 
 
+# Sequence positions where motifs of the source (designed) sequence start or end in an aligned tree
+def get_motif_boundaries(aligned_tree) -> List[int]:
+    boundaries = set()
+    tree_stack = [aligned_tree]
+    while tree_stack:
+        top = tree_stack.pop()
+        tree_stack.extend(top.children)
+        if top.mode != 'T':
+            for start, end in _index_ranges(top.value.index_list):
+                boundaries.add(start)
+                boundaries.add(end)
+    return sorted(boundaries)
+
+
+# (start, end) sequence ranges of the preserved nodes of a target tree (see design_context.merge_motifs)
+def get_preserved_ranges(target_tree) -> List[Tuple[int, int]]:
+    ranges = []
+    tree_stack = [target_tree]
+    while tree_stack:
+        top = tree_stack.pop()
+        tree_stack.extend(top.children)
+        if top.value.preserve:
+            ranges.extend(_index_ranges(top.value.index_list))
+    return sorted(ranges)
+
+
+# Per position (of the designed sequence) mismatch weights of an aligned tree: +1 for positions of source only
+# (deleted) nodes, of the closest source node above a target only (inserted) node, of matched nodes with a non zero
+# sequence alignment score (score only alignment rules) and of get_matching_indexes unmatching positions.
+# All zero for a perfect match.
+def get_mismatch_weights(aligned_tree, length: int) -> List[int]:
+    weights = [0] * length
+
+    def add(index_list):
+        for index in index_list:
+            if 0 <= index < length:
+                weights[index] += 1
+    tree_stack = [(aligned_tree, None)]
+    while tree_stack:
+        top, source_parent = tree_stack.pop()
+        for child in top.children:
+            tree_stack.append((child, top if top.mode != 'T' else source_parent))
+        if top.mode == 'S':
+            add(top.value.index_list)
+        elif top.mode == 'T':
+            if source_parent is not None:
+                add(source_parent.value.index_list)
+        elif isinstance(top.value_align, LazyAlignment):
+            if align_sequences(top.value_align.sequence_one, top.value_align.sequence_two, score_only=True)[0] > 0:
+                add(top.value.index_list)
+    add([index - 1 for index in get_matching_indexes(aligned_tree)[1]])
+    return weights
+
+
 if __name__ == "__main__":
     '''
     logging.basicConfig(level=logging.DEBUG)
     '''
+    import random
+    random.seed(1)
+    print('Test single pass tree builder against parsing the shapiro strings')
+
+    def random_structure(length):
+        res = ''
+        while len(res) < length:
+            inner_length = length - len(res) - 2
+            if inner_length >= 3 and random.random() < 0.6:
+                res += '(' + random_structure(random.randint(3, inner_length)) + ')'
+            else:
+                res += '.'
+        return res
+
+    def tree_signature(tree):
+        return (tree.value.name, tree.value.size, tree.value.index_list, tree.value.sequence,
+                [tree_signature(child) for child in tree.children])
+
+    tree_mismatch = 0
+    for _ in range(500):
+        structure = random_structure(random.randint(0, 120))
+        sequence = ''.join(random.choice('ACGU') for _ in structure)
+        shapiro = shapiro_generator.get_shapiro(structure)
+        if tree_signature(structure_to_tree(structure, sequence)) != \
+                tree_signature(shapiro_to_tree(shapiro.shapiro, shapiro.shapiro_indexes, sequence)):
+            tree_mismatch += 1
+            print('Tree mismatch for {}'.format(structure))
+    print('{} tree mismatches'.format(tree_mismatch))
+    print('Test unconstrained segment closed form against the DP')
+    mismatch_count = 0
+    for i in range(0, 2000):
+        segment_one = ''.join(random.choice(IUPAC.IUPAC_RNA_BASE + 'NRY') for j in range(0, random.randint(0, 15)))
+        segment_two = random.choice(['', 'N' * random.randint(1, 15),
+                                     ''.join(random.choice('NNNNACGUn') for j in range(0, random.randint(1, 15)))])
+        if random.random() < 0.5:
+            segment_one, segment_two = '', segment_one
+        closed_form = _align_unconstrained(segment_one, segment_two)
+        if closed_form is not None and closed_form != _align_single_seq_dp(segment_one, segment_two):
+            mismatch_count += 1
+            print("Closed form mismatch: '{}' '{}' {} {}".format(segment_one, segment_two, closed_form,
+                                                              _align_single_seq_dp(segment_one, segment_two)))
+    print('{} mismatches\n'.format(mismatch_count))
     '''
     print('Simple test 1')
     shapiro_one = shapiro_generator.get_shapiro("((((((((..((((((.......))))....))))))")
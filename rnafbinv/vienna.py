@@ -125,6 +125,15 @@ class LiveRNAfold:
         structure_map = output_fold_analyze('\n'.join(lines))
         return structure_map
 
+    # writes all sequences at once and reads the results in order (no round trip per sequence)
+    def fold_many(self, sequences: List[str]) -> List[Dict[str, str]]:
+        write_lines = "".join(["{}\n".format(sequence) for sequence in sequences])
+        if self.logger is not None:
+            self.logger.debug("LiveRNAfold, writing {} sequences [\n{}\n]".format(len(sequences), write_lines))
+        self.proc.stdin.write(write_lines)
+        self.proc.stdin.flush()
+        return [output_fold_analyze('\n'.join(self._read_until_ready())) for _ in sequences]
+
 
 # single use call to RNA fold
 def fold(sequence: str, is_circular: bool=False, structure_constraints: str = None) -> Dict[str, str]:
@@ -12,6 +12,7 @@ setuptools.setup(name='rnafbinv', version='2.0.4',
                  author="Matan Drory Retwitzer",
                  author_email="matandro@post.bgu.ac.il",
                  packages=['rnafbinv'],
+                 install_requires=['numpy'],
                  script=['bin/RNAfbinv'],
                  classifiers=(
                      "Programming Language :: Python :: 3",
@@ -9,6 +9,8 @@ from subprocess import Popen
 import logging
 import os
 
+from rnafbinv import rna_structure
+
 
 VARNA_PATH = 'VARNAv3-93.jar'
 
@@ -24,26 +26,14 @@ def set_java_path(path: str):
 
 
 def generate_temp_ct(structure, sequence, title=''):
-    comp_map = {}
-    closing_stack = []
-    for i in range(0, len(sequence)):
-        if structure[i] == '(':
-            closing_stack.append(i)
-        elif structure[i] == ')':
-            start_index = closing_stack.pop()
-            comp_map[start_index] = i
-            comp_map[i] = start_index
+    pair_table = rna_structure.get_structure(structure).pair_table
     temp_file = NTF(dir='.', delete=False, suffix='.ct', mode='w')
     temp_file.write('{}\t{}\n'.format(len(structure), title))
     for i in range(0, len(sequence)):
         next_item = i + 2
         if next_item > len(sequence):
             next_item = 0
-        comp = comp_map.get(i)
-        if comp is None:
-            comp = 0
-        else:
-            comp += 1
+        comp = int(pair_table[i]) + 1
         line = "{}\t{}\t{}\t{}\t{}\t{}\n".format(i + 1, sequence[i], i, next_item, comp, i)
         temp_file.write(line)
     temp_file.close()